@@ -1,144 +1,389 @@
 from queue import Queue, Empty
-from threading import Thread
 import argparse
 import math
 import time
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
+import numpy as np
 import picar_4wd as fc
 
-from map import Mapper, Ray
+from map import Mapper, Ray, inflate_obstacles
 from common import Car, Radar
+from frontier import FrontierTracker
+from localizer import ScanMatcher
+from planner import Planner
+from recorder import Recorder, RecordingBackend
+from startup import CORE_MODULES, PLOT_MODULES, Prewarmer
+from tracking import has_stop_sign
 
 
 MAP_SIZE = 60
+# cell driven to unless exploring
+DESTINATION = (MAP_SIZE // 2, 28)
+# centimeters of ultrasonic distance per map cell
+DIST_SCALE = 7
+
+# path following, distances in cells
+LOOKAHEAD = 2.0
+GOAL_TOLERANCE = 0.75
+MAX_CURVATURE = 1.0
+SPIN_ANGLE = math.radians(60)
+REPLAN_AHEAD = 4
+# most frontiers visited in one exploration run
+MAX_FRONTIERS = 20
+# a prior map is trusted if it scores at least this when aligned within
+# the given degrees and cells of where this run started
+MIN_ALIGN_SCORE = 0.5
+PRIOR_ANGLE_RANGE = 30
+PRIOR_MAX_SHIFT = 10
+PROBE_ANGLES = (-20, -10, 0, 10)
+# inflate_obstacles never marks cells this far from an obstacle
+INFLATION_REACH = 3
 
 
-terminate_program = False
 ignore_stop_sign = False
 
 
+def add_reading(mapper: Mapper, car: Car, angle: float, dist: float,
+                confidence: float = 1.0) -> None:
+    """Add an ultrasonic reading taken at servo angle from the car to the map"""
+    angle_in_rad = math.radians(-angle) + car.curr_dir
+    angle_in_rad %= (2 * math.pi)
+    position = car.get_position().round().astype(int)
+    mapper.add_ray(Ray(tuple(position), angle_in_rad,
+                       round(dist / DIST_SCALE), confidence))
+
+
+def localize(matcher: ScanMatcher, mapper: Mapper, car: Car,
+             sweep: List[Tuple[int, float, float]]) -> None:
+    """Correct the car pose by matching a stationary sweep against the map
+    and the sweeps before it"""
+    readings = [(math.radians(-angle), dist / DIST_SCALE)
+                for angle, dist, confidence in sweep
+                if confidence >= mapper.min_confidence and
+                dist != Radar.NO_ECHO]
+    matcher.set_map(mapper.data)
+    pose = matcher.match(car.get_position(), car.curr_dir, readings)
+    if pose is not None:
+        print("Corrected pose", (pose.x, pose.y), math.degrees(pose.dir))
+        car.set_pose((pose.x, pose.y), pose.dir)
+    matcher.add_sweep(mapper.data.shape, car.get_position(), car.curr_dir,
+                      readings)
+
+
+def path_blocked(mapper: Mapper, points: np.ndarray,
+                 start: Tuple[int, int]) -> bool:
+    """Whether an obstacle was mapped onto a stretch of path since it was
+    planned from start
+
+    The path cells are checked on the same inflated grid the planner searched,
+    so a path the planner just returned is never blocked. The occupancy
+    pyramid answers the common case of nothing mapped nearby without
+    inflating the grid.
+    """
+    cells = points.round().astype(int)
+    # inflation always marks start itself, the planner only keeps the cells
+    # after it clear
+    cells = cells[(cells != start).any(axis=1)]
+    if not len(cells):
+        return False
+    min_x, min_y = cells.min(axis=0) - INFLATION_REACH
+    max_x, max_y = cells.max(axis=0) + INFLATION_REACH
+    if not mapper.any_filled(min_x, max_x, min_y, max_y):
+        return False
+    obstacles = inflate_obstacles(mapper.data, start)
+    return bool(obstacles[cells[:, 1], cells[:, 0]].any())
+
+
+def _wrap_angle(angle_in_rad: float) -> float:
+    """wrap an angle to [-pi, pi)"""
+    return (angle_in_rad + math.pi) % (2 * math.pi) - math.pi
+
+
 def navigate(
     path: List[Tuple[int, int]],
     car: Car,
     radar: Radar,
     queue: Queue,
+    planner: Optional[Planner] = None,
+    recorder: Optional[Recorder] = None,
+    debug=None,
 ) -> bool:
     """Attempt to navigate to the given path. Returns True if successful, False 
-    otherwise"""
-    global ignore_stop_sign
+    otherwise
 
-    i = 0
-    while i < len(path) - 1:
-        curr_loc, next_loc = path[i], path[i+1]
-        delta = (next_loc[0] - curr_loc[0], next_loc[1] - curr_loc[1])
-        for j in range(i + 1, len(path)):
-            prev_loc, _curr_loc = path[j-1], path[j]
-            if _curr_loc[0] - prev_loc[0] != delta[0] or \
-                    _curr_loc[1] - prev_loc[1] != delta[1]:
-                break
-            i = j
-        waypoint = path[i]
-
-        # find direction to waypoint
-        dir_in_rad = math.atan2(
-            waypoint[1] - curr_loc[1], waypoint[0] - curr_loc[0])
-        print(math.degrees(dir_in_rad))
-        car.turn_absolute(dir_in_rad)
-        car.forward()
-
-        prev_dist = math.inf
-        while True:
-            curr_car_pos = car.get_position().round().astype(int)
-            print(curr_car_pos, car.curr_dir, waypoint)
-            dist = math.sqrt((curr_car_pos[0] - waypoint[0]) ** 2 +
-                             (curr_car_pos[1] - waypoint[1]) ** 2)
-            if prev_dist < dist:
-                break
-            prev_dist = min(prev_dist, dist)
-
-            stop_sign_detected = False
-            if queue is not None:
-                print("fetch queue...", end=' ')
-                has_stop_sign = None
-                while True:
-                    try:
-                        has_stop_sign = queue.get_nowait()
-                    except Empty:
-                        break
-                print('has stop sign =', has_stop_sign)
-                if has_stop_sign is not None and has_stop_sign is True and \
-                        not ignore_stop_sign:
-                    ignore_stop_sign = True
-                    stop_sign_detected = True
-                    car.stop()
-                    time.sleep(3)
-                    car.forward()
-
-            if not stop_sign_detected:
-                dist = radar.get_distance_at(0, sleep_duration=0.25)
-                for angle in range(-20, 20, 10):
-                    dist = radar.get_distance_at(angle, sleep_duration=0.05)
-                    if dist < 10:
-                        print("Angle: ", angle, "Distance: ", dist)
-                        print("encountered obstacle, stop and return")
-                        car.stop()
-                        return False
-        car.stop()
+    The path is followed continuously with pure pursuit: the car steers along
+    the arc through a point LOOKAHEAD cells ahead on the path using differential
+    wheel power, and only spins in place when that point is far off its heading.
 
-    return True
+    With a planner, obstacle probes are added to its map and the path beyond a
+    point a few cells ahead is replanned in the background. A fresher route is
+    spliced in as long as the car has not reached that point yet.
 
+    A debug_stream.DebugStream passed as debug is shown the map, car and path.
+    """
+    global ignore_stop_sign
+
+    points = np.array(path, dtype=float)
+    progress = 0
+    replan_index: Optional[int] = None
+    probe = 0
+    while True:
+        position = car.get_position()
+        if recorder is not None:
+            recorder.pose(position, car.curr_dir)
+        if debug is not None and planner is not None:
+            debug.submit_map(planner.mapper.data, position, path)
 
-def object_detection_cv(queue: Queue):
-    global terminate_program
+        # advance to the closest path point just ahead of the last one
+        window = points[progress:progress + 2 * REPLAN_AHEAD]
+        progress += int(np.argmin(np.linalg.norm(window - position, axis=1)))
+        distances = np.linalg.norm(points[progress:] - position, axis=1)
+        ahead = np.flatnonzero(distances >= LOOKAHEAD)
+        target_index = progress + ahead[0] if len(ahead) else len(points) - 1
+        target = points[target_index]
+        # the goal is allowed to end up next to an obstacle, only the way
+        # there has to stay clear
+        stretch = points[progress:target_index + 1]
+        stretch = stretch[np.linalg.norm(stretch - points[-1], axis=1) >=
+                          INFLATION_REACH]
+        if planner is not None and \
+                path_blocked(planner.mapper, stretch, path[0]):
+            print("obstacle mapped on the path, stop and return")
+            car.stop()
+            return False
 
-    from detect import run as detect
-    detector = detect("efficientdet_lite0.tflite", 0, 640, 480, 4, False)
-    for has_stop_sign in detector:
-        print("[cv] has stop sign =", has_stop_sign)
-        queue.put(has_stop_sign)
-        if terminate_program or ignore_stop_sign:
+        dx, dy = target - position
+        alpha = _wrap_angle(math.atan2(dy, dx) - car.curr_dir)
+        if progress == len(points) - 1 and (
+                distances[-1] < GOAL_TOLERANCE or abs(alpha) > math.pi / 2):
             break
-        time.sleep(0.5)
+        print(position, math.degrees(car.curr_dir), target)
+        if abs(alpha) > SPIN_ANGLE:
+            car.spin(alpha)
+        else:
+            curvature = 2 * math.sin(alpha) / max(math.hypot(dx, dy), 1e-6)
+            car.steer(max(-MAX_CURVATURE, min(MAX_CURVATURE, curvature)))
+
+        if queue is not None:
+            print("fetch queue...", end=' ')
+            stop_sign_seen = False
+            while True:
+                try:
+                    detections = queue.get_nowait()
+                except Empty:
+                    break
+                stop_sign = has_stop_sign(detections)
+                stop_sign_seen = stop_sign_seen or stop_sign
+                if recorder is not None:
+                    recorder.detection(stop_sign)
+            print('has stop sign =', stop_sign_seen)
+            if stop_sign_seen and not ignore_stop_sign:
+                ignore_stop_sign = True
+                pause = getattr(queue, 'pause', None)
+                if pause is not None:
+                    # the stop sign is handled, nothing left to detect
+                    pause()
+                car.stop()
+                car.clock.sleep(3)
+                continue
+
+        # probe one angle per control step so steering stays responsive
+        angle = PROBE_ANGLES[probe % len(PROBE_ANGLES)]
+        probe += 1
+        dist, confidence = radar.get_distance_burst(angle, sleep_duration=0.05)
+        if planner is not None:
+            add_reading(planner.mapper, car, angle, dist, confidence)
+        # readings the map would drop do not stop the car either, without a
+        # map every close reading does. A radar without bursts always
+        # reports a confidence of 1, so only bursts make this gate matter.
+        min_confidence = planner.mapper.min_confidence \
+            if planner is not None else 0.0
+        if dist < 10 and confidence >= min_confidence:
+            print("Angle: ", angle, "Distance: ", dist)
+            print("encountered obstacle, stop and return")
+            car.stop()
+            return False
+
+        if planner is not None:
+            reply = planner.poll()
+            if reply is not None and replan_index is not None:
+                _request_id, start, fresh_path = reply
+                if fresh_path and progress < replan_index and \
+                        start == tuple(path[replan_index]) and \
+                        fresh_path != path[replan_index:]:
+                    print("Switching to fresher path...")
+                    path = path[:replan_index] + fresh_path
+                    points = np.array(path, dtype=float)
+            if replan_index is None or progress >= replan_index:
+                replan_index = None
+                if progress + REPLAN_AHEAD < len(path) - 1:
+                    replan_index = progress + REPLAN_AHEAD
+                    planner.request(path[replan_index], path[-1])
+    car.stop()
+
+    return True
 
 
-def main(object_detection: bool = False):
-    global terminate_program
+def main(object_detection: bool = False, hw=None, clock=None,
+         plot: bool = True, queue=None,
+         recorder: Optional[Recorder] = None,
+         debug_port: Optional[int] = None, explore: bool = False,
+         prior_map: Optional[str] = None,
+         save_map: Optional[str] = None,
+         dest: Tuple[int, int] = DESTINATION) -> bool:
+    """Map the surroundings and drive to the destination, or explore them
 
-    queue = Queue()
+    Args:
+        object_detection (bool, optional): stop at stop signs detected by a
+            worker process. Defaults to False.
+        hw (optional): picar_4wd compatible backend, e.g. a simulator.
+            Defaults to picar_4wd.
+        clock (optional): clock for the car and radar. Defaults to the time
+            module.
+        plot (bool, optional): plot the map and path after every scan.
+            Defaults to True.
+        queue (optional): source of stop sign detections, e.g. a replayed log.
+            Defaults to a new queue.
+        recorder (Optional[Recorder], optional): record sensor readings,
+            motor commands, poses and detections. Defaults to None.
+        debug_port (Optional[int], optional): serve camera frames and the map
+            as an MJPEG stream on this localhost port. Defaults to None.
+        explore (bool, optional): instead of driving to the destination,
+            keep driving to the most promising frontier between mapped and
+            unknown space until none is left. Defaults to False.
+        prior_map (Optional[str], optional): .npy map of an earlier run in the
+            same space. It is aligned to the first scan and fills in what
+            this run has not seen yet. Defaults to None.
+        save_map (Optional[str], optional): save the map to this .npy file at
+            the end of the run. Defaults to None.
+        dest (Tuple[int, int], optional): cell to drive to unless exploring.
+            Defaults to DESTINATION.
 
-    thread: Thread
-    if object_detection:
-        thread = Thread(target=object_detection_cv, args=(queue,)).start()
+    Returns:
+        bool: True if the destination was reached or nothing is left to
+            explore, False if MAX_FRONTIERS were visited with frontiers left
+    """
+    if queue is None and not object_detection:
+        queue = Queue()
+    if recorder is not None:
+        hw = RecordingBackend(hw if hw is not None else fc, recorder)
 
-    radar = Radar()
     mapper = Mapper(size=MAP_SIZE, dist_cutoff=6, connect_cutoff=6)
+    detector = None
+    debug = None
+    try:
+        # processes fork before any thread starts, a child only gets the
+        # forking thread and could inherit locks the others held
+        with Planner(mapper) as planner:
+            if object_detection:
+                from vision_worker import DetectionWorker
+                detector = DetectionWorker("efficientdet_lite0.tflite")
+                if queue is None:
+                    queue = detector
+            if debug_port is not None:
+                from debug_stream import DebugStream
+                debug = DebugStream(debug_port)
+                if detector is not None:
+                    detector.debug = debug
+            return _run_mission(
+                hw, clock, plot, queue, recorder, planner,
+                detector.update_motion if detector is not None else None,
+                debug, explore, np.load(prior_map) if prior_map else None,
+                dest)
+    finally:
+        if save_map:
+            np.save(save_map, mapper.data)
+        if detector is not None:
+            detector.close()
+        if debug is not None:
+            debug.close()
+
+
+def _run_mission(hw, clock, plot: bool, queue,
+                 recorder: Optional[Recorder], planner: Planner,
+                 on_motion=None, debug=None, explore: bool = False,
+                 prior: Optional[np.ndarray] = None,
+                 dest: Tuple[int, int] = DESTINATION) -> bool:
+    """Scan, plan and drive until the destination is reached, or until no
+    frontier is left when exploring"""
+    radar = Radar(hw=hw, clock=clock, burst_samples=5)
     car = Car(position=(MAP_SIZE // 2, 20),
-              dir_in_rad=math.radians(90))
+              dir_in_rad=math.radians(90), hw=hw, clock=clock)
+    car.on_motion = on_motion
+    mapper = planner.mapper
+    matcher = ScanMatcher()
+    frontiers = FrontierTracker(mapper) if explore else None
 
-    dest = (MAP_SIZE // 2, 28)
+    visited = 0
+    # every process is running by now, the first scan hides the imports
+    Prewarmer(CORE_MODULES + (PLOT_MODULES if plot else ()))
     while True:
         print("Scanning...")
-        for _ in range(15):
-            angle, dist = radar.scan_step()
-            angle_in_rad = math.radians(-angle) + car.curr_dir
-            angle_in_rad %= (2 * math.pi)
-            position = car.get_position().round().astype(int)
-            ray = Ray(tuple(position), angle_in_rad, round(dist / 7))
-            mapper.add_ray(ray)
+        sweep = [radar.scan_step() for _ in range(15)]
+        localize(matcher, mapper, car, sweep)
+        if recorder is not None:
+            recorder.pose(car.get_position(), car.curr_dir)
+        for angle, dist, confidence in sweep:
+            add_reading(mapper, car, angle, dist, confidence)
+        if prior is not None:
+            _merge_prior(mapper, prior)
+            prior = None
         print("Finding path...")
-        path = mapper.route(car.get_position().round().astype(int), dest)
-        mapper.plot(path=path, save_file=f"./debug/map-{time.time()}.jpg")
+        start = car.get_position().round().astype(int)
+        if frontiers is not None:
+            path = None
+            while path is None and visited < MAX_FRONTIERS:
+                frontier = frontiers.best(car.get_position())
+                if frontier is None:
+                    break
+                dest = frontier.goal
+                print("Exploring frontier at", dest)
+                planner.request(start, dest)
+                path = planner.wait()
+                # once visited or found unreachable it is not a goal
+                # anymore, whatever is left of it shows up again nearby
+                frontiers.reject([dest])
+                visited += 1
+            if path is None:
+                if visited >= MAX_FRONTIERS and \
+                        frontiers.best(car.get_position()) is not None:
+                    print("Frontier budget exhausted!")
+                    return False
+                print("Nothing left to explore!")
+                return True
+        else:
+            planner.request(start, dest)
+            path = planner.wait()
+        if debug is not None:
+            debug.submit_map(mapper.data, car.get_position(), path)
+        if plot:
+            mapper.plot(path=path,
+                        save_file=f"./debug/map-{time.time()}.jpg")
         if path is None:
             print("No path found!")
-            return
+            return False
         print("Following path...")
-        if navigate(path, car, radar, queue):
+        if navigate(path, car, radar, queue, planner, recorder, debug) \
+                and frontiers is None:
             break
     print("Reached destination!")
+    return True
+
+
+def _merge_prior(mapper: Mapper, prior: np.ndarray) -> None:
+    """Fill in what the first scan has not seen from an earlier run's map"""
+    from map_merge import align, merge
 
-    terminate_program = True
-    thread.join()
+    # runs start at the same pose in their own map, so the car was put
+    # down about where it started last time
+    alignment = align(mapper.data, prior, angle_range=PRIOR_ANGLE_RANGE,
+                      max_shift=PRIOR_MAX_SHIFT)
+    print("Prior map alignment", alignment)
+    if alignment.score < MIN_ALIGN_SCORE:
+        print("Prior map does not match, ignoring it")
+        return
+    mapper.set_data(merge(mapper.data, prior, alignment))
 
 
 if __name__ == '__main__':
@@ -149,11 +394,43 @@ if __name__ == '__main__':
         help='Use object detection',
         required=False,
         default=False)
+    parser.add_argument(
+        '-r', '--record',
+        help='Save a log of the run to this .npz file for replay.py',
+        required=False,
+        default=None)
+    parser.add_argument(
+        '-d', '--debugPort',
+        help='Serve camera frames and the map as MJPEG on this localhost port',
+        required=False,
+        type=int,
+        default=None)
+    parser.add_argument(
+        '-e', '--explore',
+        help='Explore the surroundings instead of driving to a destination',
+        action='store_true',
+        required=False,
+        default=False)
+    parser.add_argument(
+        '-p', '--priorMap',
+        help='Start from the .npy map of an earlier run in the same space',
+        required=False,
+        default=None)
+    parser.add_argument(
+        '-s', '--saveMap',
+        help='Save the map to this .npy file at the end of the run',
+        required=False,
+        default=None)
     args = parser.parse_args()
 
+    recorder = Recorder() if args.record else None
     try:
-        main(args.objectDetection)
+        main(args.objectDetection, recorder=recorder,
+             debug_port=args.debugPort, explore=args.explore,
+             prior_map=args.priorMap, save_map=args.saveMap)
     except Exception as e:
         print(e)
     finally:
         fc.stop()
+        if recorder is not None:
+            recorder.save(args.record)
@@ -0,0 +1,245 @@
+"""Benchmark the detection pipeline without a camera
+
+Frames come from a video file, a directory of images or a synthetic scene, and
+the detector backend is either the TFLite model or a deterministic stub. The
+report lists throughput and latency percentiles of the capture, preprocess,
+inference and postprocess stages.
+"""
+import argparse
+import glob
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from preprocess import FramePreprocessor
+from tracking import STOP_SIGN, Detection, DetectionTracker
+
+
+STAGES = ('capture', 'preprocess', 'inference', 'postprocess')
+
+
+def video_frames(path: str) -> Iterator[np.ndarray]:
+    """Frames of a video file"""
+    cap = cv2.VideoCapture(path)
+    try:
+        while True:
+            success, frame = cap.read()
+            if not success:
+                return
+            yield frame
+    finally:
+        cap.release()
+
+
+def image_frames(directory: str) -> Iterator[np.ndarray]:
+    """Images of a directory in name order"""
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        frame = cv2.imread(path)
+        if frame is not None:
+            yield frame
+
+
+def synthetic_frames(width: int = 640, height: int = 480,
+                     seed: int = 0) -> Iterator[np.ndarray]:
+    """Endless noisy scene with a red sign drifting across the raw frame"""
+    rng = np.random.RandomState(seed)
+    background = cv2.GaussianBlur(
+        rng.randint(0, 255, (height, width, 3)).astype(np.uint8), (9, 9), 3)
+    size = height // 6
+    i = 0
+    while True:
+        frame = background.copy()
+        x = (i * 4) % (width - size)
+        y = height // 3
+        center = (x + size // 2, y + size // 2)
+        cv2.circle(frame, center, size // 2, (0, 0, 200), -1)
+        cv2.circle(frame, center, size // 4, (255, 255, 255), -1)
+        yield frame
+        i += 1
+
+
+class StubBackend:
+    """Deterministic stand-in for the model that finds strongly red regions
+
+    An optional busy wait emulates the model's inference time.
+    """
+
+    def __init__(self, latency: float = 0.0, min_area: int = 16):
+        self.latency = latency
+        self.min_area = min_area
+
+    def infer(self, rgb_image: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        deadline = time.perf_counter() + self.latency
+        red = (rgb_image[..., 0] > 150) & (rgb_image[..., 1] < 80) & \
+            (rgb_image[..., 2] < 80)
+        while time.perf_counter() < deadline:
+            pass
+        if red.sum() < self.min_area:
+            return None
+        ys, xs = np.nonzero(red)
+        return (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+
+    def postprocess(self, result: Optional[Tuple[int, int, int, int]],
+                    preprocess: FramePreprocessor,
+                    timestamp: float) -> List[Detection]:
+        if result is None:
+            return []
+        x0, y0 = preprocess.to_frame(result[0], result[1])
+        x1, y1 = preprocess.to_frame(result[2], result[3])
+        box = (int(round(x0)), int(round(y0)),
+               int(round(x1 - x0)), int(round(y1 - y0)))
+        return [Detection(STOP_SIGN, 1.0, box, timestamp)]
+
+
+class TFLiteBackend:
+    """The TFLite object detection model used on the car"""
+
+    def __init__(self, model: str, num_threads: int = 4,
+                 enable_edgetpu: bool = False):
+        import detect
+        from tflite_support.task import vision
+
+        self._detect = detect
+        self._vision = vision
+        self.detector = detect.create_detector(model, num_threads,
+                                               enable_edgetpu)
+
+    def infer(self, rgb_image: np.ndarray):
+        input_tensor = self._vision.TensorImage.create_from_array(rgb_image)
+        return self.detector.detect(input_tensor)
+
+    def postprocess(self, result, preprocess: FramePreprocessor,
+                    timestamp: float) -> List[Detection]:
+        return self._detect.to_detections(result, preprocess, timestamp)
+
+
+def benchmark(frames: Iterator[np.ndarray], backend,
+              preprocess: FramePreprocessor, max_frames: int = 200,
+              warmup: int = 5) -> Dict[str, np.ndarray]:
+    """Run frames through the pipeline and time every stage
+
+    Args:
+        frames (Iterator[np.ndarray]): raw BGR frames
+        backend: object with infer and postprocess like StubBackend
+        preprocess (FramePreprocessor): frame preprocessing
+        max_frames (int, optional): frames to time. Defaults to 200.
+        warmup (int, optional): frames run before timing starts. Defaults
+            to 5.
+
+    Returns:
+        Dict[str, np.ndarray]: seconds per frame of every stage and 'total'
+            for the whole run
+    """
+    tracker = DetectionTracker()
+    timings = {stage: [] for stage in STAGES}
+    detected = 0
+    start = None
+    for i in range(warmup + max_frames):
+        if i == warmup:
+            start = time.perf_counter()
+        t0 = time.perf_counter()
+        frame = next(frames, None)
+        if frame is None:
+            break
+        t1 = time.perf_counter()
+        rgb_image = preprocess(frame)
+        t2 = time.perf_counter()
+        result = backend.infer(rgb_image)
+        t3 = time.perf_counter()
+        detections = tracker.update(
+            frame, backend.postprocess(result, preprocess, t0), t0)
+        t4 = time.perf_counter()
+        if i < warmup:
+            continue
+        detected += bool(detections)
+        for stage, duration in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2,
+                                            t4 - t3)):
+            timings[stage].append(duration)
+    total = time.perf_counter() - start if start is not None else 0.0
+    stats = {stage: np.array(values) for stage, values in timings.items()}
+    stats['total'] = np.array([total])
+    stats['detected'] = np.array([detected])
+    return stats
+
+
+def report(stats: Dict[str, np.ndarray]) -> str:
+    """Format throughput and per stage latency percentiles in milliseconds"""
+    count = len(stats['capture'])
+    total = float(stats['total'][0])
+    lines = [f'frames: {count}  throughput: '
+             f'{count / total if total else 0.0:.1f} fps  '
+             f'frames with detections: {int(stats["detected"][0])}',
+             f'{"stage":<12}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}']
+    for stage in STAGES:
+        values = stats[stage] * 1000
+        if not len(values):
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        lines.append(f'{stage:<12}{p50:>9.2f}{p90:>9.2f}{p99:>9.2f}'
+                     f'{values.max():>9.2f}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--video', help='Video file to read frames from.')
+    source.add_argument('--images', help='Directory of images to read.')
+    parser.add_argument(
+        '--backend',
+        help='Detector to benchmark.',
+        choices=['stub', 'tflite'],
+        default='stub')
+    parser.add_argument(
+        '--model',
+        help='Path of the object detection model.',
+        default='efficientdet_lite0.tflite')
+    parser.add_argument(
+        '--numThreads',
+        help='Number of CPU threads to run the model.',
+        type=int,
+        default=4)
+    parser.add_argument(
+        '--stubLatency',
+        help='Seconds the stub backend spends per inference.',
+        type=float,
+        default=0.0)
+    parser.add_argument(
+        '--frames', help='Number of frames to time.', type=int, default=200)
+    parser.add_argument(
+        '--inputSize',
+        help='Width and height frames are resized to before inference.',
+        nargs=2,
+        type=int,
+        default=[320, 320])
+    parser.add_argument(
+        '--roi',
+        help='Region of interest as x, y, width and height fractions.',
+        nargs=4,
+        type=float,
+        default=None)
+    args = parser.parse_args()
+
+    if args.video:
+        frames = video_frames(args.video)
+    elif args.images:
+        frames = image_frames(args.images)
+    else:
+        frames = synthetic_frames()
+
+    if args.backend == 'tflite':
+        backend = TFLiteBackend(args.model, args.numThreads)
+    else:
+        backend = StubBackend(args.stubLatency)
+
+    preprocess = FramePreprocessor(tuple(args.inputSize),
+                                   tuple(args.roi) if args.roi else None)
+    print(report(benchmark(frames, backend, preprocess, args.frames)))
+
+
+if __name__ == '__main__':
+    main()
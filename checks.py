@@ -0,0 +1,143 @@
+"""Headless checks of the pieces missions depend on, run by `make check`
+
+Each check raises on failure. `python checks.py` runs them all and exits
+with status 1 if any failed.
+"""
+import math
+import sys
+import traceback
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+import simulator  # noqa: F401, installs the picar_4wd mock off the car
+from autopilot import MAX_CURVATURE, add_reading, localize
+from common import Car, Radar
+from localizer import ScanMatcher
+from map import Mapper
+from scheduler import InferenceScheduler
+from simulator import SimClock, Simulator, arena
+
+
+class _ScriptedSensor:
+    """Backend whose ultrasonic sensor returns the given readings in turn"""
+
+    def __init__(self, readings: Sequence[float]):
+        self._readings = list(readings)
+        self.servo = self
+        self.us = self
+
+    def set_angle(self, angle: float) -> None:
+        pass
+
+    def get_distance(self) -> float:
+        return self._readings.pop(0)
+
+
+def check_burst_even_disagreement() -> None:
+    """An even burst whose readings disagree still yields a reading"""
+    radar = Radar(hw=_ScriptedSensor([10, 50]), clock=SimClock(),
+                  burst_samples=2)
+    distance, confidence = radar.get_distance_burst(0)
+    assert distance == 10, distance
+    assert confidence == 0.5, confidence
+
+
+def check_burst_agreement() -> None:
+    """A burst stops as soon as enough readings agree"""
+    radar = Radar(hw=_ScriptedSensor([40, 41, 90]), clock=SimClock(),
+                  burst_samples=3)
+    distance, confidence = radar.get_distance_burst(0)
+    assert distance == 40.5, distance
+    assert confidence == 1.0, confidence
+
+
+def check_pyramid_queries() -> None:
+    """Box queries agree with reducing the grid after random updates"""
+    rng = np.random.RandomState(0)
+    mapper = Mapper(size=37)
+    for _ in range(100):
+        x, y = rng.randint(0, 37, 2)
+        width, height = rng.randint(1, 10, 2)
+        mapper.data[y:y + height, x:x + width] = rng.randint(0, 3)
+        mapper.mark_dirty(x, min(x + width, 37) - 1, y,
+                          min(y + height, 37) - 1)
+        min_x, max_x = sorted(rng.randint(-3, 40, 2))
+        min_y, max_y = sorted(rng.randint(-3, 40, 2))
+        box = mapper.data[max(min_y, 0):max(max_y + 1, 0),
+                          max(min_x, 0):max(max_x + 1, 0)]
+        expected = (box.max(), box.min()) if box.size else (None, None)
+        pyramid = mapper.pyramid
+        assert (pyramid.box_max(min_x, max_x, min_y, max_y),
+                pyramid.box_min(min_x, max_x, min_y, max_y)) == expected
+
+
+def check_scan_matching_corrects_drift() -> None:
+    """A sweep after driving a miscalibrated car pulls the pose back"""
+    clock = SimClock()
+    sim = Simulator(arena(60), (30, 16), math.radians(90), clock=clock,
+                    drift=0.3)
+    radar = Radar(hw=sim, clock=clock, burst_samples=5)
+    car = Car((30, 16), math.radians(90), hw=sim, clock=clock)
+    mapper = Mapper(size=60, dist_cutoff=6, connect_cutoff=6)
+    matcher = ScanMatcher()
+    sweep = [radar.scan_step() for _ in range(15)]
+    localize(matcher, mapper, car, sweep)
+    for angle, dist, confidence in sweep:
+        add_reading(mapper, car, angle, dist, confidence)
+
+    # dead reckoning falls 30% short of the distance driven
+    car.forward()
+    clock.sleep(5)
+    car.stop()
+    drifted = car.get_position()
+    error = np.linalg.norm(drifted - sim.position)
+    assert error > 1, error
+    localize(matcher, mapper, car, [radar.scan_step() for _ in range(15)])
+    assert not np.array_equal(car.get_position(), drifted), "no correction"
+    corrected = np.linalg.norm(car.get_position() - sim.position)
+    assert corrected < error / 2, (error, corrected)
+
+
+def check_scheduler_steering_is_not_spinning() -> None:
+    """Steering the sharpest curve keeps inference up, spinning slows it"""
+    scheduler = InferenceScheduler()
+    car = Car((30, 30), 0, hw=Simulator(arena(60), (30, 30), 0),
+              clock=SimClock())
+    car.on_motion = scheduler.update_motion
+    for curvature in (MAX_CURVATURE, -MAX_CURVATURE):
+        car.steer(curvature)
+        assert math.isclose(scheduler.interval(), scheduler.min_interval), \
+            curvature
+    for direction in (1, -1):
+        car.spin(direction)
+        assert math.isclose(scheduler.interval(), scheduler.max_interval), \
+            direction
+
+
+CHECKS: List[Callable[[], None]] = [
+    check_burst_even_disagreement,
+    check_burst_agreement,
+    check_pyramid_queries,
+    check_scan_matching_corrects_drift,
+    check_scheduler_steering_is_not_spinning,
+]
+
+
+def main() -> None:
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print("FAILED", check.__name__)
+            traceback.print_exc()
+        else:
+            print("ok", check.__name__)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 "Common helper classes for pi car"""
 import math
+import statistics
 import time
-from typing import Iterable, Tuple, Union
+from typing import Callable, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import picar_4wd as fc
@@ -10,20 +11,48 @@ import picar_4wd as fc
 class Radar:
     """Control and read from the ultrasonic sensor"""
 
-    def __init__(self, angle_range: int = 180, angle_step: int = 18):
+    # centimeters reported when nothing echoed back
+    NO_ECHO = 100
+
+    def __init__(self, angle_range: int = 180, angle_step: int = 18,
+                 hw=None, clock=None, burst_samples: int = 1,
+                 burst_agree: int = 2, burst_tolerance: float = 3,
+                 burst_interval: float = 0.01):
+        """
+        Args:
+            angle_range (int, optional): sweep range in degrees. Defaults to 180.
+            angle_step (int, optional): sweep step in degrees. Defaults to 18.
+            hw (optional): picar_4wd compatible backend. Defaults to picar_4wd.
+            clock (optional): object providing sleep and monotonic. Defaults to
+                the time module.
+            burst_samples (int, optional): most readings taken per burst.
+                Defaults to 1 which takes a single reading.
+            burst_agree (int, optional): readings that must agree to end a
+                burst early. Defaults to 2.
+            burst_tolerance (float, optional): distance in centimeters within
+                which readings agree with the median. Defaults to 3.
+            burst_interval (float, optional): pause between readings of a
+                burst. Defaults to 0.01.
+        """
         self.angle_range = angle_range
         self.angle_step = angle_step
         self.step_direction = 1
         self.current_angle: int = 0
+        self.burst_samples = burst_samples
+        self.burst_agree = burst_agree
+        self.burst_tolerance = burst_tolerance
+        self.burst_interval = burst_interval
 
-        self.servo = fc.servo
+        self.hw = hw if hw is not None else fc
+        self.clock = clock if clock is not None else time
+        self.servo = self.hw.servo
         self.servo.set_angle(self.current_angle)
 
-    def scan_step(self) -> Tuple[int, float]:
-        """scan environment and return angle and distance
+    def scan_step(self) -> Tuple[int, float, float]:
+        """scan environment and return angle, distance and confidence
 
         Returns:
-            Tuple[int, float]: tuple of angle and distance
+            Tuple[int, float, float]: tuple of angle, distance and confidence
         """
         max_angle = self.angle_range // 2
         min_angle = -max_angle
@@ -35,8 +64,9 @@ class Radar:
         elif self.current_angle <= min_angle:
             self.current_angle = min_angle
             self.step_direction = -self.step_direction
-        dist = self.get_distance_at(self.current_angle, sleep_duration=0.1)
-        return self.current_angle, dist
+        dist, confidence = self.get_distance_burst(self.current_angle,
+                                                   sleep_duration=0.1)
+        return self.current_angle, dist, confidence
 
     def get_distance_at(self, angle: float, sleep_duration: float = 0.04) -> float:
         """get distance at angle
@@ -49,38 +79,213 @@ class Radar:
             float: _description_
         """
         self.servo.set_angle(angle)
-        time.sleep(sleep_duration)
-        distance = fc.us.get_distance()
+        self.clock.sleep(sleep_duration)
+        distance = self.hw.us.get_distance()
         if distance < 0:
-            distance = 100
+            distance = self.NO_ECHO
 
         return distance
 
+    def get_distance_burst(self, angle: float,
+                           sleep_duration: float = 0.04) -> Tuple[float, float]:
+        """get a consensus distance at angle from a burst of readings
+
+        Readings are taken until `burst_agree` of them lie within
+        `burst_tolerance` of their median and the median absolute deviation is
+        within tolerance too, or until `burst_samples` readings were taken.
+        The readings are then centered on their low median, which is one of
+        them, so a burst that never agreed still returns its nearer half.
+
+        Args:
+            angle (float): angle of the ultrasonic sensor in degrees
+            sleep_duration (float, optional): duration for sensor to turn. Defaults to 0.04.
+
+        Returns:
+            Tuple[float, float]: median of the agreeing readings and the
+                fraction of readings that agree with it
+        """
+        self.servo.set_angle(angle)
+        self.clock.sleep(sleep_duration)
+        samples = []
+        for i in range(max(self.burst_samples, 1)):
+            if i > 0:
+                self.clock.sleep(self.burst_interval)
+            distance = self.hw.us.get_distance()
+            samples.append(self.NO_ECHO if distance < 0 else distance)
+            if len(samples) >= self.burst_agree and self._consensus(samples):
+                break
+
+        # an even burst that disagrees has no reading near its mean median
+        median = statistics.median_low(samples)
+        agreeing = [s for s in samples
+                    if abs(s - median) <= self.burst_tolerance]
+        return statistics.median(agreeing), len(agreeing) / len(samples)
+
+    def _consensus(self, samples: List[float]) -> bool:
+        """whether enough readings agree with the median of the burst"""
+        median = statistics.median(samples)
+        deviations = [abs(s - median) for s in samples]
+        agreeing = sum(d <= self.burst_tolerance for d in deviations)
+        return agreeing >= self.burst_agree and \
+            statistics.median(deviations) <= self.burst_tolerance
+
 
 class Car:
     """Control the pi car movement while keeping track of position and direction"""
     _SPEED = 5
     _SPEED_SCALER = 1 / 4
     _TURN_SCALER = (17 / 15) / (2 * math.pi)
+    # the car needs twice the power to turn left, see turn_relative
+    _LEFT_TURN_GAIN = 0.5
 
-    def __init__(self, position: Iterable, dir_in_rad: float):
-        self._position = np.array(position)
-        self.curr_dir = dir_in_rad
+    def __init__(self, position: Iterable, dir_in_rad: float,
+                 hw=None, clock=None):
+        """
+        Args:
+            position (Iterable): start position in the form of [x, y]
+            dir_in_rad (float): start direction in radians
+            hw (optional): picar_4wd compatible backend. Defaults to picar_4wd.
+            clock (optional): object providing sleep and monotonic. Defaults to
+                the time module.
+        """
+        self._position = np.array(position, dtype=float)
+        self._dir = dir_in_rad
+        self.hw = hw if hw is not None else fc
+        self.clock = clock if clock is not None else time
 
+        # time the current motion started from _position and _dir
         self.start_time: Union[float, None] = None
+        self._speed = 0.0
+        self._turn_rate = 0.0
+        # called with the new speed and turn rate whenever the motion changes
+        self.on_motion: Optional[Callable[[float, float], None]] = None
+
+    @classmethod
+    def velocity_from_power(cls, left: float, right: float) -> Tuple[float, float]:
+        """linear and angular velocity resulting from wheel powers
+
+        Args:
+            left (float): power of the left wheels
+            right (float): power of the right wheels
+
+        Returns:
+            Tuple[float, float]: speed in cells per second and turn rate in
+                radians per second, positive for left
+        """
+        speed = (left + right) / 2 * cls._SPEED_SCALER
+        turn_rate = (right - left) / 2 / (cls._SPEED ** 2 * cls._TURN_SCALER)
+        if turn_rate > 0:
+            turn_rate *= cls._LEFT_TURN_GAIN
+        return speed, turn_rate
+
+    @classmethod
+    def power_for_velocity(cls, speed: float,
+                           turn_rate: float) -> Tuple[float, float]:
+        """wheel powers needed for a linear and angular velocity
+
+        Args:
+            speed (float): speed in cells per second
+            turn_rate (float): turn rate in radians per second, positive for left
+
+        Returns:
+            Tuple[float, float]: power of the left and right wheels
+        """
+        mean = speed / cls._SPEED_SCALER
+        if turn_rate > 0:
+            turn_rate /= cls._LEFT_TURN_GAIN
+        diff = turn_rate * cls._SPEED ** 2 * cls._TURN_SCALER
+        return mean - diff, mean + diff
+
+    @property
+    def curr_dir(self) -> float:
+        """current direction of the car in radians"""
+        return self._get_pose()[1]
+
+    @curr_dir.setter
+    def curr_dir(self, dir_in_rad: float):
+        self._commit()
+        self._dir = dir_in_rad
+
+    def _get_pose(self) -> Tuple[np.ndarray, float]:
+        """integrate the current motion up to now"""
+        if self.start_time is None:
+            return self._position.copy(), self._dir
+        duration = self.clock.monotonic() - self.start_time
+        if abs(self._turn_rate) < 1e-9:
+            dir_vec = np.array([np.cos(self._dir), np.sin(self._dir)])
+            return self._position + dir_vec * duration * self._speed, self._dir
+        new_dir = self._dir + self._turn_rate * duration
+        radius = self._speed / self._turn_rate
+        offset = radius * np.array([np.sin(new_dir) - np.sin(self._dir),
+                                    np.cos(self._dir) - np.cos(new_dir)])
+        return self._position + offset, new_dir % (2 * math.pi)
+
+    def _commit(self):
+        """fold the motion so far into the stored pose"""
+        self._position, self._dir = self._get_pose()
+        if self.start_time is not None:
+            self.start_time = self.clock.monotonic()
+
+    def _set_motion(self, speed: float, turn_rate: float):
+        self._commit()
+        if self.on_motion is not None and \
+                (speed, turn_rate) != (self._speed, self._turn_rate):
+            self.on_motion(speed, turn_rate)
+        self._speed, self._turn_rate = speed, turn_rate
+        if speed == 0 and turn_rate == 0:
+            self.start_time = None
+        elif self.start_time is None:
+            self.start_time = self.clock.monotonic()
 
     def forward(self):
         """move forward"""
-        if not self.start_time:
-            fc.forward(self._SPEED)
-            self.start_time = time.monotonic()
+        if self.start_time is None or self._turn_rate != 0:
+            self.hw.forward(self._SPEED)
+            self._set_motion(self._SPEED * self._SPEED_SCALER, 0)
+
+    def set_power(self, left: float, right: float):
+        """drive the left and right wheels independently to follow a curve
+
+        Args:
+            left (float): power of the left wheels
+            right (float): power of the right wheels
+        """
+        self.hw.left_front.set_power(left)
+        self.hw.left_rear.set_power(left)
+        self.hw.right_front.set_power(right)
+        self.hw.right_rear.set_power(right)
+        self._set_motion(*self.velocity_from_power(left, right))
+
+    @property
+    def cruise_speed(self) -> float:
+        """speed of forward in cells per second"""
+        return self._SPEED * self._SPEED_SCALER
+
+    def steer(self, curvature: float):
+        """drive at cruise speed along an arc without stopping
+
+        Args:
+            curvature (float): inverse of the turn radius in cells, positive
+                for left and 0 for straight
+        """
+        self.set_power(*self.power_for_velocity(
+            self.cruise_speed, self.cruise_speed * curvature))
+
+    def spin(self, direction: float):
+        """turn in place at the rate turn_relative uses
+
+        Args:
+            direction (float): positive for left, negative for right
+        """
+        turn_rate = 1 / (self._SPEED * self._TURN_SCALER)
+        self.set_power(*self.power_for_velocity(
+            0, math.copysign(turn_rate, direction)))
 
     def stop(self):
         """stop the car"""
-        fc.stop()
-        self._position = self.get_position()
-        self.start_time = None
-        time.sleep(0.5)
+        self.hw.stop()
+        self._set_motion(0, 0)
+        self.clock.sleep(0.5)
 
     def turn_relative(self, angle_in_rad: float):
         """turn the car by angle in radians
@@ -93,13 +298,13 @@ class Car:
             return
 
         if angle_in_rad > 0:
-            fc.turn_left(int(round(self._SPEED * 2)))
+            self.hw.turn_left(int(round(self._SPEED * 2)))
         else:
-            fc.turn_right(self._SPEED)
+            self.hw.turn_right(self._SPEED)
 
-        time.sleep(abs(angle_in_rad) * self._SPEED * self._TURN_SCALER)
-        fc.stop()
-        time.sleep(0.5)
+        self.clock.sleep(abs(angle_in_rad) * self._SPEED * self._TURN_SCALER)
+        self.hw.stop()
+        self.clock.sleep(0.5)
 
         self.curr_dir += angle_in_rad
         self.curr_dir %= 2 * math.pi
@@ -127,16 +332,22 @@ class Car:
         """
         self.turn_absolute(math.radians(dir_in_deg))
 
+    def set_pose(self, position: Iterable, dir_in_rad: float):
+        """overwrite the pose estimate, e.g. with a scan matching correction
+
+        Args:
+            position (Iterable): position of the car in the form of [x, y]
+            dir_in_rad (float): direction in radians
+        """
+        if self.start_time is not None:
+            self.start_time = self.clock.monotonic()
+        self._position = np.array(position, dtype=float)
+        self._dir = dir_in_rad % (2 * math.pi)
+
     def get_position(self) -> np.ndarray:
         """get current position of the car
 
         Returns:
             np.ndarray: position of the car in the form of [x, y]
         """
-        if self.start_time is not None:
-            duration = time.monotonic() - self.start_time
-            dir_vec = np.array([np.cos(self.curr_dir),
-                                np.sin(self.curr_dir)])
-            return self._position + dir_vec * duration * self._SPEED * self._SPEED_SCALER
-        else:
-            return self._position.copy()
+        return self._get_pose()[0]
@@ -0,0 +1,296 @@
+"""Serve annotated camera frames and the map as an MJPEG stream on localhost
+
+Open http://localhost:8080/ in a browser, or forward the port over ssh, to see
+what the car sees next to what it mapped. Drawing and JPEG encoding run on a
+low priority thread, and frames are dropped whenever nobody is watching or
+the encoder has not finished the previous one, so the stream never slows
+down driving or inference.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from map import Mapper
+from tracking import Detection
+
+
+_BOUNDARY = b'frame'
+_PAGE = b'<html><body style="margin:0;background:#000">' \
+    b'<img src="/stream" style="width:100%"></body></html>'
+
+# BGR colors of the map cells
+_MAP_COLORS = np.zeros((3, 3), dtype=np.uint8)
+_MAP_COLORS[Mapper.EMPTY] = (255, 255, 255)
+_MAP_COLORS[Mapper.UNKNOWN] = (160, 160, 160)
+_MAP_COLORS[Mapper.FILLED] = (0, 0, 0)
+
+
+def render_map(data: np.ndarray, height: int,
+               position: Optional[Sequence[float]] = None,
+               path: Optional[List[Tuple[int, int]]] = None) -> np.ndarray:
+    """Draw a map grid as a BGR image with y pointing up
+
+    Args:
+        data (np.ndarray): the map grid
+        height (int): image height in pixels, the width keeps the aspect
+        position (Optional[Sequence[float]], optional): car position in cells.
+            Defaults to None.
+        path (Optional[List[Tuple[int, int]]], optional): path to draw.
+            Defaults to None.
+
+    Returns:
+        np.ndarray: the image
+    """
+    import cv2
+
+    scale = height / data.shape[0]
+    width = int(round(data.shape[1] * scale))
+    # Mapper.data is float, index the colors with its integer cell values
+    cells = np.flipud(data).astype(np.intp)
+    image = cv2.resize(_MAP_COLORS[cells], (width, height),
+                       interpolation=cv2.INTER_NEAREST)
+
+    def pixel(x: float, y: float) -> Tuple[int, int]:
+        return (int((x + 0.5) * scale), int((data.shape[0] - y - 0.5) * scale))
+
+    if path:
+        points = np.array([pixel(x, y) for x, y in path], dtype=np.int32)
+        cv2.polylines(image, [points], False, (0, 0, 255), 2)
+    if position is not None:
+        cv2.circle(image, pixel(*position), max(int(scale), 3),
+                   (0, 160, 0), -1)
+    return image
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: '_Server'
+
+    def do_GET(self) -> None:
+        if self.path == '/':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(_PAGE)))
+            self.end_headers()
+            self.wfile.write(_PAGE)
+        elif self.path == '/stream':
+            self._stream()
+        else:
+            self.send_error(404)
+
+    def _stream(self) -> None:
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; '
+                         'boundary=' + _BOUNDARY.decode())
+        self.end_headers()
+        stream = self.server.stream
+        stream._connect(1)
+        try:
+            last_id = 0
+            while stream.running:
+                jpeg, last_id = stream._wait_jpeg(last_id)
+                if jpeg is None:
+                    continue
+                self.wfile.write(b'--' + _BOUNDARY + b'\r\n'
+                                 b'Content-Type: image/jpeg\r\n'
+                                 b'Content-Length: ' +
+                                 str(len(jpeg)).encode() + b'\r\n\r\n')
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stream._connect(-1)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    stream: 'DebugStream'
+
+
+class DebugStream:
+    """MJPEG endpoint showing annotated camera frames next to the map
+
+    submit_frame and submit_map only store a reference and return at once.
+    The newest frame waits for the encoder in a single slot, anything older
+    that was not encoded yet is dropped.
+    """
+
+    def __init__(self, port: int = 8080, host: str = '127.0.0.1',
+                 quality: int = 70, max_fps: float = 10.0,
+                 map_height: int = 480):
+        """
+        Args:
+            port (int, optional): port to serve on. Defaults to 8080.
+            host (str, optional): address to bind, localhost unless the
+                stream should be reachable from other machines. Defaults to
+                '127.0.0.1'.
+            quality (int, optional): JPEG quality. Defaults to 70.
+            max_fps (float, optional): most frames encoded per second.
+                Defaults to 10.0.
+            map_height (int, optional): height of the map render when there
+                is no camera frame. Defaults to 480.
+        """
+        self.quality = quality
+        self.min_interval = 1 / max_fps
+        self.map_height = map_height
+        self.running = True
+        # frames dropped because nobody watched or the encoder was busy
+        self.dropped = 0
+        self.clients = 0
+
+        self._cond = threading.Condition()
+        self._frame: Optional[np.ndarray] = None
+        self._detections: Sequence[Detection] = []
+        self._map: Optional[Tuple[np.ndarray, Optional[Tuple[float, float]],
+                                  Optional[List[Tuple[int, int]]]]] = None
+        self._pending = False
+        self._jpeg: Optional[bytes] = None
+        self._jpeg_id = 0
+
+        self._server = _Server((host, port), _Handler)
+        self._server.stream = self
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._server_thread.start()
+        self._encoder = threading.Thread(target=self._encode_loop,
+                                         daemon=True)
+        self._encoder.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _connect(self, delta: int) -> None:
+        with self._cond:
+            self.clients += delta
+
+    def submit_frame(self, frame: np.ndarray,
+                     detections: Optional[Sequence[Detection]] = None) -> bool:
+        """Offer a raw camera frame to the stream
+
+        The frame must not be modified afterwards, the encoder reads it later.
+
+        Args:
+            frame (np.ndarray): the raw BGR camera frame
+            detections (Optional[Sequence[Detection]], optional): detections
+                to draw on it. Defaults to the last ones set.
+
+        Returns:
+            bool: False if the frame was dropped right away
+        """
+        with self._cond:
+            if not self.clients:
+                self.dropped += 1
+                return False
+            if self._pending:
+                self.dropped += 1
+            self._frame = frame
+            if detections is not None:
+                self._detections = detections
+            self._pending = True
+            self._cond.notify_all()
+        return True
+
+    def set_detections(self, detections: Sequence[Detection]) -> None:
+        """Detections drawn on the following frames"""
+        with self._cond:
+            self._detections = detections
+
+    def submit_map(self, data: np.ndarray,
+                   position: Optional[Sequence[float]] = None,
+                   path: Optional[List[Tuple[int, int]]] = None) -> bool:
+        """Offer the current map, copied as the mapper keeps changing it
+
+        Returns:
+            bool: False if nobody is watching and the map was ignored
+        """
+        with self._cond:
+            if not self.clients:
+                return False
+            self._map = (data.copy(),
+                         tuple(position) if position is not None else None,
+                         list(path) if path else None)
+            if self._frame is None:
+                # no camera, the map alone drives the stream
+                self._pending = True
+            self._cond.notify_all()
+        return True
+
+    def _wait_jpeg(self, last_id: int) -> Tuple[Optional[bytes], int]:
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._jpeg_id != last_id or not self.running, 1.0)
+            if self._jpeg_id == last_id:
+                return None, last_id
+            return self._jpeg, self._jpeg_id
+
+    def _encode_loop(self) -> None:
+        import cv2
+        import utils
+
+        try:
+            # only this thread, the GIL is released while encoding
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        last = 0.0
+        while self.running:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending or not self.running, 1.0)
+                if not self._pending:
+                    continue
+                frame, detections = self._frame, self._detections
+                map_state = self._map
+                self._pending = False
+            time.sleep(max(0.0, last + self.min_interval - time.monotonic()))
+            last = time.monotonic()
+
+            try:
+                panels = []
+                if frame is not None:
+                    # detections are reported on the flipped frame
+                    panels.append(
+                        utils.visualize(cv2.flip(frame, -1), detections))
+                if map_state is not None:
+                    height = panels[0].shape[0] if panels else self.map_height
+                    panels.append(
+                        render_map(map_state[0], height, *map_state[1:]))
+                if not panels:
+                    continue
+                success, jpeg = cv2.imencode(
+                    '.jpg', np.hstack(panels),
+                    [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if not success:
+                    continue
+            except Exception as e:
+                # a bad frame or map must not end the stream
+                print('Debug stream could not encode a frame:', e)
+                continue
+            with self._cond:
+                self._jpeg = jpeg.tobytes()
+                self._jpeg_id += 1
+                self._cond.notify_all()
+
+    def close(self) -> None:
+        """Stop encoding and serving"""
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._encoder.join(timeout=1)
+
+    def __enter__(self) -> 'DebugStream':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
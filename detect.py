@@ -14,19 +14,196 @@
 """Main script to run the object detection routine."""
 import argparse
 import sys
+import threading
 import time
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple
 
 import cv2
-from tflite_support.task import core
-from tflite_support.task import processor
-from tflite_support.task import vision
-import utils
+import numpy as np
+from preprocess import FramePreprocessor
+from tracking import Detection, DetectionTracker
+
+if TYPE_CHECKING:
+    # TFLite takes seconds to load, it is imported once a detector is created
+    from tflite_support.task import processor
+    from tflite_support.task import vision
+
+
+class LatestFrameCapture:
+    """Read camera frames on a background thread, keeping only the newest.
+
+    OpenCV buffers several frames inside the driver, so a loop that reads a
+    frame only after finishing inference on the previous one sees stale images.
+    Reading continuously on a separate thread and handing out the newest frame
+    means inference always works on the freshest image; older ones are dropped.
+    """
+
+    def __init__(self, camera_id: int, width: int, height: int,
+                 on_frame: Optional[Callable[[np.ndarray, float], None]] = None
+                 ) -> None:
+        """Starts capturing from the camera.
+
+        Args:
+          camera_id: The camera id to be passed to OpenCV.
+          width: The width of the frame captured from the camera.
+          height: The height of the frame captured from the camera.
+          on_frame: Called on the capture thread with every new frame and its
+            capture timestamp.
+        """
+        self._cap = cv2.VideoCapture(camera_id)
+        self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self._on_frame = on_frame
+
+        self._cond = threading.Condition()
+        self._frame: Optional[np.ndarray] = None
+        self._timestamp = 0.0
+        self._frame_id = 0
+        self._read_id = 0
+        self.dropped = 0
+        self._running = self._cap.isOpened()
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def _capture(self) -> None:
+        while self._running:
+            success, frame = self._cap.read()
+            timestamp = time.monotonic()
+            with self._cond:
+                if not success:
+                    self._running = False
+                else:
+                    # cap.read allocates a new array, readers may keep the old one
+                    self._frame = frame
+                    self._timestamp = timestamp
+                    self._frame_id += 1
+                self._cond.notify_all()
+            if success and self._on_frame is not None:
+                self._on_frame(frame, timestamp)
+
+    @property
+    def running(self) -> bool:
+        """Whether the camera is open and still delivering frames"""
+        return self._running
+
+    def isOpened(self) -> bool:
+        return self._running or self._frame_id != self._read_id
+
+    def read(self, timeout: float = 1.0
+             ) -> Tuple[bool, Optional[np.ndarray], float]:
+        """Waits for a frame newer than the last one read.
+
+        Args:
+          timeout: Seconds to wait for a new frame.
+
+        Returns:
+          Whether a frame was read, the frame and its capture timestamp on the
+          time.monotonic clock.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._frame_id != self._read_id or not self._running,
+                timeout)
+            if self._frame_id == self._read_id:
+                return False, None, 0.0
+            self.dropped += self._frame_id - self._read_id - 1
+            self._read_id = self._frame_id
+            return True, self._frame, self._timestamp
+
+    def release(self) -> None:
+        self._running = False
+        self._thread.join(timeout=1)
+        self._cap.release()
+
+
+def create_detector(model: str, num_threads: int,
+                    enable_edgetpu: bool) -> 'vision.ObjectDetector':
+    """Initializes the object detection model.
+
+    Args:
+      model: Name of the TFLite object detection model.
+      num_threads: The number of CPU threads to run the model.
+      enable_edgetpu: True/False whether the model is a EdgeTPU model.
+
+    Returns:
+      The object detector.
+    """
+    from tflite_support.task import core
+    from tflite_support.task import processor
+    from tflite_support.task import vision
+
+    base_options = core.BaseOptions(
+        file_name=model, use_coral=enable_edgetpu, num_threads=num_threads)
+    detection_options = processor.DetectionOptions(
+        max_results=3, score_threshold=0.3)
+    options = vision.ObjectDetectorOptions(
+        base_options=base_options, detection_options=detection_options)
+    return vision.ObjectDetector.create_from_options(options)
+
+
+def detect_objects(detector: 'vision.ObjectDetector', rgb_image: np.ndarray,
+                   preprocess: FramePreprocessor,
+                   timestamp: float) -> List[Detection]:
+    """Runs the detector on a preprocessed RGB image.
+
+    Args:
+      detector: The object detector.
+      rgb_image: The model input.
+      preprocess: The preprocessor that produced rgb_image, used to map boxes
+        back onto the flipped camera frame.
+      timestamp: Capture time of the frame.
+
+    Returns:
+      The detected objects.
+    """
+    from tflite_support.task import vision
+
+    # Create a TensorImage object from the RGB image.
+    input_tensor = vision.TensorImage.create_from_array(rgb_image)
+
+    # Run object detection estimation using the model.
+    detection_result = detector.detect(input_tensor)
+    return to_detections(detection_result, preprocess, timestamp)
+
+
+def to_detections(detection_result: 'processor.DetectionResult',
+                  preprocess: FramePreprocessor,
+                  timestamp: float) -> List[Detection]:
+    """Converts the model output into detections on the flipped frame.
+
+    Args:
+      detection_result: The output of the object detector.
+      preprocess: The preprocessor that produced the model input.
+      timestamp: Capture time of the frame.
+
+    Returns:
+      The detected objects.
+    """
+    objects = []
+    for detection in detection_result.detections:
+        category = detection.categories[0]
+        bbox = detection.bounding_box
+        x0, y0 = preprocess.to_frame(bbox.origin_x, bbox.origin_y)
+        x1, y1 = preprocess.to_frame(bbox.origin_x + bbox.width,
+                                     bbox.origin_y + bbox.height)
+        box = (int(round(x0)), int(round(y0)),
+               int(round(x1 - x0)), int(round(y1 - y0)))
+        objects.append(
+            Detection(category.category_name, category.score, box, timestamp))
+    return objects
 
 
 def run(model: str, camera_id: int, width: int, height: int, num_threads: int,
-        enable_edgetpu: bool) -> None:
+        enable_edgetpu: bool,
+        input_size: Optional[Tuple[int, int]] = (320, 320),
+        roi: Optional[Tuple[float, float, float, float]] = None,
+        scheduler=None, debug=None,
+        max_timeouts: int = 5) -> Iterator[List[Detection]]:
     """Continuously run inference on images acquired from the camera.
 
+    Yields the timestamped detections of every frame the model ran on, and of
+    the frames in between while the tracker follows earlier detections.
+
     Args:
       model: Name of the TFLite object detection model.
       camera_id: The camera id to be passed to OpenCV.
@@ -34,16 +211,26 @@ def run(model: str, camera_id: int, width: int, height: int, num_threads: int,
       height: The height of the frame captured from the camera.
       num_threads: The number of CPU threads to run the model.
       enable_edgetpu: True/False whether the model is a EdgeTPU model.
+      input_size: (width, height) frames are resized to before inference,
+        which should match the model input. None keeps camera resolution.
+      roi: (x, y, width, height) region of interest as fractions of the frame,
+        e.g. the right-hand road edge where signs appear. None uses it all.
+      scheduler: Optional scheduler.InferenceScheduler deciding which frames
+        to run the model on. The tracker covers the others. None runs it on
+        every frame.
+      debug: Optional debug_stream.DebugStream shown the annotated frames.
+      max_timeouts: Reads in a row that may time out before giving up on the
+        camera. A read that finds the capture thread stopped gives up at once.
     """
 
     # Variables to calculate FPS
     counter, fps = 0, 0
     start_time = time.time()
 
-    # Start capturing video input from the camera
-    cap = cv2.VideoCapture(camera_id)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    # Start capturing video input from the camera on its own thread
+    cap = LatestFrameCapture(camera_id, width, height)
+    preprocess = FramePreprocessor(input_size, roi)
+    tracker = DetectionTracker()
 
     # Visualization parameters
     row_size = 20  # pixels
@@ -54,44 +241,42 @@ def run(model: str, camera_id: int, width: int, height: int, num_threads: int,
     fps_avg_frame_count = 10
 
     # Initialize the object detection model
-    base_options = core.BaseOptions(
-        file_name=model, use_coral=enable_edgetpu, num_threads=num_threads)
-    detection_options = processor.DetectionOptions(
-        max_results=3, score_threshold=0.3)
-    options = vision.ObjectDetectorOptions(
-        base_options=base_options, detection_options=detection_options)
-    detector = vision.ObjectDetector.create_from_options(options)
+    detector = create_detector(model, num_threads, enable_edgetpu)
 
     # Continuously capture images from the camera and run inference
+    timeouts = 0
     while cap.isOpened():
-        success, image = cap.read()
+        success, image, timestamp = cap.read()
         if not success:
-            sys.exit(
-                'ERROR: Unable to read from webcam. Please verify your webcam settings.'
-            )
+            # a late frame is skipped, a dead or stalled camera is not
+            timeouts += 1
+            if not cap.running or timeouts >= max_timeouts:
+                sys.exit(
+                    'ERROR: Unable to read from webcam. Please verify your webcam settings.'
+                )
+            continue
+        timeouts = 0
+        if scheduler is not None and \
+                not scheduler.should_run(image, time.monotonic()):
+            detections = tracker.track(image, timestamp)
+            if debug is not None:
+                debug.submit_frame(image, detections)
+            if detections:
+                yield detections
+            continue
 
         counter += 1
-        image = cv2.flip(image, 1)
-        image = cv2.flip(image, 0)  # flip upside down
+        # Crop, resize, flip upside down and convert the image from BGR to RGB
+        # as required by the TFLite model.
+        rgb_image = preprocess(image)
 
-        # Convert the image from BGR to RGB as required by the TFLite model.
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        objects = detect_objects(detector, rgb_image, preprocess, timestamp)
 
-        # Create a TensorImage object from the RGB image.
-        input_tensor = vision.TensorImage.create_from_array(rgb_image)
-
-        # Run object detection estimation using the model.
-        detection_result = detector.detect(input_tensor)
-        objects = []
-        for detection in detection_result.detections:
-            category = detection.categories[0]
-            category_name = category.category_name
-            objects.append(category_name)
-
-        yield "stop sign" in objects
-
-        # Draw keypoints and edges on input image
-        # image = utils.visualize(image, detection_result)
+        detections = tracker.update(image, objects, timestamp)
+        if debug is not None:
+            # drawn on the stream's encoder thread, inference does not wait
+            debug.submit_frame(image, detections)
+        yield detections
 
         # Calculate the FPS
         if counter % fps_avg_frame_count == 0:
@@ -149,10 +334,41 @@ def main():
         action='store_true',
         required=False,
         default=False)
+    parser.add_argument(
+        '--inputSize',
+        help='Width and height frames are resized to before inference.',
+        required=False,
+        nargs=2,
+        type=int,
+        default=[320, 320])
+    parser.add_argument(
+        '--roi',
+        help='Region of interest as x, y, width and height fractions.',
+        required=False,
+        nargs=4,
+        type=float,
+        default=None)
+    parser.add_argument(
+        '--debugPort',
+        help='Serve annotated frames as MJPEG on this localhost port.',
+        required=False,
+        type=int,
+        default=None)
     args = parser.parse_args()
 
-    run(args.model, int(args.cameraId), args.frameWidth, args.frameHeight,
-        int(args.numThreads), bool(args.enableEdgeTPU))
+    debug = None
+    if args.debugPort is not None:
+        from debug_stream import DebugStream
+        debug = DebugStream(args.debugPort)
+    try:
+        for _ in run(args.model, int(args.cameraId), args.frameWidth,
+                     args.frameHeight, int(args.numThreads),
+                     bool(args.enableEdgeTPU), tuple(args.inputSize),
+                     tuple(args.roi) if args.roi else None, debug=debug):
+            pass
+    finally:
+        if debug is not None:
+            debug.close()
 
 
 if __name__ == '__main__':
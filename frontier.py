@@ -0,0 +1,197 @@
+"""Find the frontiers between explored and unknown space to explore next
+
+A frontier cell is an EMPTY cell with an UNKNOWN 4-neighbour. The frontier
+mask is only recomputed around the cells the mapper reports as changed, and
+only the clusters touching those cells are labelled again, so an update costs
+about as much as the rays that caused it.
+"""
+from typing import (Dict, Iterable, List, NamedTuple, Optional, Sequence,
+                    Tuple)
+
+import numpy as np
+
+from map import Mapper, grow_box
+
+
+class Frontier(NamedTuple):
+    # member cell closest to the centroid, a reachable goal unlike the
+    # centroid itself
+    goal: Tuple[int, int]
+    # number of cells
+    size: int
+    centroid: Tuple[float, float]
+
+
+class FrontierTracker:
+    """Keep the frontier cells of a mapper up to date and cluster them"""
+
+    def __init__(self, mapper: Mapper, min_size: int = 3,
+                 piece_size: int = 8, min_distance: float = 3.0):
+        """
+        Args:
+            mapper (Mapper): the map to track
+            min_size (int, optional): fewest cells a frontier needs to be worth
+                visiting. Defaults to 3.
+            piece_size (int, optional): longer frontiers are split into pieces
+                of at most this many cells across, otherwise the centroid of a
+                frontier wrapping around the car lies next to the car.
+                Defaults to 8.
+            min_distance (float, optional): frontiers whose goal is closer
+                than this to the car or a rejected goal are skipped. Defaults
+                to 3.0.
+        """
+        self.mapper = mapper
+        self.min_size = min_size
+        self.piece_size = piece_size
+        self.min_distance = min_distance
+        self.mask = np.zeros(mapper.data.shape, dtype=bool)
+        # goals that could not be reached or did not reveal anything
+        self.rejected: List[Tuple[int, int]] = []
+        self._stale: Optional[Tuple[int, int, int, int]] = None
+        # cells of the mask changed since they were last clustered
+        self._unclustered: Optional[Tuple[int, int, int, int]] = None
+        # cluster id of every frontier cell, 0 elsewhere
+        self._labels = np.zeros(mapper.data.shape, dtype=np.int32)
+        # bounding box and pieces of every cluster by id, including the ones
+        # too small to report
+        self._clusters: Dict[int, Tuple[Tuple[int, int, int, int],
+                                        List[Frontier]]] = {}
+        self._next_id = 1
+        mapper.add_listener(self._on_change)
+        if (mapper.data != Mapper.UNKNOWN).any():
+            height, width = mapper.data.shape
+            self._on_change(0, width - 1, 0, height - 1)
+
+    def _on_change(self, min_x: int, max_x: int, min_y: int,
+                   max_y: int) -> None:
+        self._stale = grow_box(self._stale, (min_x, max_x, min_y, max_y))
+
+    def update(self) -> None:
+        """Recompute the frontier mask around the cells changed since the last
+        update"""
+        if self._stale is None:
+            return
+        height, width = self.mask.shape
+        min_x, max_x, min_y, max_y = self._stale
+        self._stale = None
+        # a change also affects whether its neighbours are frontier cells
+        min_x, min_y = max(min_x - 1, 0), max(min_y - 1, 0)
+        max_x, max_y = min(max_x + 1, width - 1), min(max_y + 1, height - 1)
+        self._unclustered = grow_box(self._unclustered,
+                                     (min_x, max_x, min_y, max_y))
+
+        # one more ring of context, padded with known cells at the border
+        x0, y0 = max(min_x - 1, 0), max(min_y - 1, 0)
+        unknown = np.pad(
+            self.mapper.data[y0:max_y + 2, x0:max_x + 2] == Mapper.UNKNOWN,
+            ((int(y0 == min_y), int(max_y == height - 1)),
+             (int(x0 == min_x), int(max_x == width - 1))))
+        near_unknown = unknown[:-2, 1:-1] | unknown[2:, 1:-1] | \
+            unknown[1:-1, :-2] | unknown[1:-1, 2:]
+        self.mask[min_y:max_y + 1, min_x:max_x + 1] = near_unknown & \
+            (self.mapper.data[min_y:max_y + 1, min_x:max_x + 1] ==
+             Mapper.EMPTY)
+
+    def frontiers(self) -> List[Frontier]:
+        """Cluster the frontier cells into 8-connected frontiers
+
+        Returns:
+            List[Frontier]: the pieces of frontiers of at least min_size cells
+        """
+        self.update()
+        if self._unclustered is not None:
+            self._cluster(*self._unclustered)
+            self._unclustered = None
+        return [piece for _, pieces in self._clusters.values()
+                for piece in pieces]
+
+    def _cluster(self, min_x: int, max_x: int, min_y: int,
+                 max_y: int) -> None:
+        """Label the clusters in and next to a box of changed mask cells"""
+        from scipy.ndimage import find_objects, label
+
+        height, width = self.mask.shape
+        # grow the box over every cluster touching it, so that no cluster
+        # is partly inside
+        while True:
+            x0, y0 = max(min_x - 1, 0), max(min_y - 1, 0)
+            ids = np.unique(self._labels[y0:max_y + 2, x0:max_x + 2])
+            ids = ids[ids > 0]
+            box = (min_x, max_x, min_y, max_y)
+            grown = box
+            for cluster_id in ids:
+                grown = grow_box(grown, self._clusters[cluster_id][0])
+            if grown == box:
+                break
+            min_x, max_x, min_y, max_y = grown
+        for cluster_id in ids:
+            del self._clusters[cluster_id]
+
+        labels, count = label(self.mask[min_y:max_y + 1, min_x:max_x + 1],
+                              structure=np.ones((3, 3), dtype=int))
+        first_id = self._next_id
+        self._next_id += count
+        self._labels[min_y:max_y + 1, min_x:max_x + 1] = \
+            np.where(labels > 0, labels + (first_id - 1), 0)
+        for index, (rows, cols) in enumerate(find_objects(labels)):
+            self._clusters[first_id + index] = (
+                (cols.start + min_x, cols.stop - 1 + min_x,
+                 rows.start + min_y, rows.stop - 1 + min_y), [])
+        if not count:
+            return
+
+        ys, xs = np.nonzero(labels)
+        ids = labels[ys, xs]
+        keep = np.bincount(ids)[ids] >= self.min_size
+        ys, xs, ids = ys[keep] + min_y, xs[keep] + min_x, ids[keep]
+        if not len(ids):
+            return
+        # number the pieces by cluster and block of piece_size cells
+        blocks_x = width // self.piece_size + 1
+        blocks = blocks_x * (height // self.piece_size + 1)
+        block = (ys // self.piece_size) * blocks_x + xs // self.piece_size
+        keys, pieces = np.unique(ids * blocks + block, return_inverse=True)
+        pieces = pieces.ravel()
+        sizes = np.bincount(pieces)
+        centroid_x = np.bincount(pieces, weights=xs) / sizes
+        centroid_y = np.bincount(pieces, weights=ys) / sizes
+        # the member closest to its piece's centroid is the first one of
+        # its piece once sorted by piece and distance
+        dist = np.hypot(xs - centroid_x[pieces], ys - centroid_y[pieces])
+        order = np.lexsort((dist, pieces))
+        _, first = np.unique(pieces[order], return_index=True)
+        for piece, i in enumerate(order[first]):
+            self._clusters[first_id - 1 + keys[piece] // blocks][1].append(
+                Frontier((int(xs[i]), int(ys[i])), int(sizes[piece]),
+                         (float(centroid_x[piece]),
+                          float(centroid_y[piece]))))
+
+    def best(self, position: Sequence[float]) -> Optional[Frontier]:
+        """The frontier promising the most new space per distance driven
+
+        Args:
+            position (Sequence[float]): the car position
+
+        Returns:
+            Optional[Frontier]: None once there is nothing left to explore
+        """
+        frontiers = self.frontiers()
+        if not frontiers:
+            return None
+        goals = np.array([f.goal for f in frontiers], dtype=float)
+        distances = np.linalg.norm(goals - np.asarray(position), axis=1)
+        valid = distances >= self.min_distance
+        if self.rejected:
+            rejected = np.array(self.rejected, dtype=float)
+            to_rejected = np.linalg.norm(
+                goals[:, None] - rejected[None], axis=2).min(axis=1)
+            valid &= to_rejected >= self.min_distance
+        if not valid.any():
+            return None
+        sizes = np.array([f.size for f in frontiers])
+        utility = np.where(valid, sizes / (distances + 1), -np.inf)
+        return frontiers[int(np.argmax(utility))]
+
+    def reject(self, goals: Iterable[Tuple[int, int]]) -> None:
+        """Skip frontiers near these goals from now on"""
+        self.rejected.extend(tuple(goal) for goal in goals)
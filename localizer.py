@@ -0,0 +1,326 @@
+"""Correct dead-reckoning drift by matching radar sweeps against the map"""
+import heapq
+import math
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from map import Mapper
+
+
+Pose = NamedTuple(
+    "Pose",
+    [
+        ('x', float),
+        ('y', float),
+        ('dir', float),
+        ('score', float),
+    ])
+
+
+def _block_max(table: np.ndarray, shift: int) -> np.ndarray:
+    """Max of each cell with the cells `shift` to its right, below and both"""
+    wide = table.copy()
+    wide[:, :-shift] = np.maximum(table[:, :-shift], table[:, shift:])
+    out = wide.copy()
+    out[:-shift, :] = np.maximum(wide[:-shift, :], wide[shift:, :])
+    return out
+
+
+class ScanMatcher:
+    """Correlative scan matcher over multi-resolution likelihood tables
+
+    Level 0 is a likelihood field that peaks on filled map cells. Level k holds
+    for every cell the maximum of level 0 over the 2^k x 2^k block starting at
+    that cell, so scoring a sweep on level k gives an upper bound for every
+    translation inside the block. A branch and bound search over the window
+    then only refines the blocks that can still beat the best pose found.
+
+    The search never reaches further than dead reckoning can have drifted
+    since the last match, and a correction is only returned if it beats the
+    odometry pose by a margin and no distinct pose explains the sweep about
+    as well, e.g. further along a straight wall.
+
+    Walls only make it into the map from close readings, so earlier sweeps
+    passed to add_sweep count as walls as well, their neighbouring end points
+    joined like the mapper joins close ones.
+    """
+
+    def __init__(self, sigma: float = 1.0, levels: int = 3,
+                 window: int = 4, angle_window: float = math.radians(10),
+                 angle_step: float = math.radians(2),
+                 max_range: float = 21, min_points: int = 5,
+                 min_score: float = 0.3, min_gain: float = 0.1,
+                 max_ambiguity: float = 0.9, drift: float = 0.2,
+                 turn_drift: float = 0.1,
+                 peak_angle: float = math.radians(6), connect: float = 6):
+        """
+        Args:
+            sigma (float, optional): spread of the likelihood field in cells.
+                Defaults to 1.0.
+            levels (int, optional): number of table resolutions. Defaults to 3.
+            window (int, optional): translation search radius in cells.
+                Defaults to 4.
+            angle_window (float, optional): rotation search radius in radians.
+                Defaults to 10 degrees.
+            angle_step (float, optional): rotation search step in radians.
+                Defaults to 2 degrees.
+            max_range (float, optional): readings at or beyond this many cells
+                are out of the sensor's range and ignored. Defaults to 21,
+                150 cm at 7 cm per cell.
+            min_points (int, optional): fewest usable readings to attempt a
+                match. Defaults to 5.
+            min_score (float, optional): lowest mean likelihood accepted as a
+                correction. Defaults to 0.3.
+            min_gain (float, optional): mean likelihood a correction must add
+                over the odometry pose. Defaults to 0.1.
+            max_ambiguity (float, optional): a match is rejected if a pose
+                more than a cell or peak_angle away scores at least this
+                fraction of the best. Defaults to 0.9.
+            drift (float, optional): cells dead reckoning may drift per cell
+                driven since the last match. Defaults to 0.2.
+            turn_drift (float, optional): radians the heading may drift per
+                radian turned since the last match. Defaults to 0.1.
+            peak_angle (float, optional): rotations this close to the best
+                one count as the same match. Defaults to 6 degrees.
+            connect (float, optional): end points of neighbouring readings of
+                a sweep at most this many cells apart are joined into a wall
+                by add_sweep. Defaults to 6.
+        """
+        self.sigma = sigma
+        self.levels = levels
+        self.window = window
+        self.angle_window = angle_window
+        self.angle_step = angle_step
+        self.max_range = max_range
+        self.min_points = min_points
+        self.min_score = min_score
+        self.min_gain = min_gain
+        self.max_ambiguity = max_ambiguity
+        self.drift = drift
+        self.turn_drift = turn_drift
+        self.peak_angle = peak_angle
+        self.connect = connect
+        self.tables: List[np.ndarray] = []
+        self._filled: Optional[np.ndarray] = None
+        # walls seen by the sweeps passed to add_sweep
+        self._hits: Optional[np.ndarray] = None
+        # odometry pose of the last match and the motion since the last
+        # confident one, None before the first match
+        self._last: Optional[Tuple[float, float, float]] = None
+        self._travelled = 0.0
+        self._turned = 0.0
+
+    def set_map(self, data: np.ndarray) -> None:
+        """Precompute the likelihood tables for a map grid
+
+        Only filled cells and sweep end points matter, the tables are kept
+        while they are the same.
+        """
+        filled = data == Mapper.FILLED
+        if self._hits is not None and self._hits.shape == filled.shape:
+            filled |= self._hits
+        if self._filled is not None and np.array_equal(filled, self._filled):
+            return
+        self._filled = filled
+        if not filled.any():
+            self.tables = []
+            return
+        from scipy.ndimage import distance_transform_edt
+
+        dist = distance_transform_edt(~filled)
+        table = np.exp(-dist ** 2 / (2 * self.sigma ** 2)).astype(np.float32)
+        self.tables = [table]
+        for k in range(1, self.levels):
+            table = _block_max(table, 1 << (k - 1))
+            self.tables.append(table)
+
+    def _usable(self, readings: Iterable[Tuple[float, float]]) -> np.ndarray:
+        """(N, 2) array of the readings in range"""
+        return np.array([r for r in readings if 0 < r[1] < self.max_range],
+                        dtype=float).reshape(-1, 2)
+
+    def add_sweep(self, shape: Tuple[int, int], position: Iterable[float],
+                  dir_in_rad: float,
+                  readings: Iterable[Tuple[float, float]]) -> None:
+        """Remember the walls a sweep saw to match later sweeps against
+
+        Args:
+            shape (Tuple[int, int]): shape of the map grid
+            position (Iterable[float]): pose the sweep was taken from in the
+                form of [x, y], ideally just corrected by match
+            dir_in_rad (float): direction the sweep was taken in in radians
+            readings (Iterable[Tuple[float, float]]): (angle relative to the
+                car in radians, distance in cells) pairs of the sweep
+        """
+        if self._hits is None or self._hits.shape != tuple(shape):
+            self._hits = np.zeros(shape, dtype=bool)
+        x, y = position
+        readings = self._usable(readings)
+        readings = readings[np.argsort(readings[:, 0])]
+        angles = dir_in_rad + readings[:, 0]
+        ends = np.stack([x + np.cos(angles) * readings[:, 1],
+                         y + np.sin(angles) * readings[:, 1]], axis=-1)
+        # neighbouring end points close together most likely lie on one wall
+        points = [ends]
+        for start, end in zip(ends, ends[1:]):
+            length = np.linalg.norm(end - start)
+            if 0 < length <= self.connect:
+                steps = np.linspace(0, 1, int(np.ceil(length * 2)) + 1)
+                points.append(start + steps[:, None] * (end - start))
+        xs, ys = np.round(np.concatenate(points)).astype(int).T
+        inside = (xs >= 0) & (xs < shape[1]) & (ys >= 0) & (ys < shape[0])
+        self._hits[ys[inside], xs[inside]] = True
+
+    def _score(self, level: int, cells: np.ndarray,
+               offsets: np.ndarray) -> np.ndarray:
+        """Sum table values of sweep cells shifted by each offset
+
+        Args:
+            level (int): table level to read
+            cells (np.ndarray): (N, 2) sweep end points as [x, y] cells
+            offsets (np.ndarray): (T, 2) translations as [dx, dy] cells
+
+        Returns:
+            np.ndarray: (T,) scores
+        """
+        table = self.tables[level]
+        xs = cells[None, :, 0] + offsets[:, None, 0]
+        ys = cells[None, :, 1] + offsets[:, None, 1]
+        # a block starting left of or below the grid still covers the cells
+        # at its edge, which the clipped lookup reads as an upper bound
+        reach = (1 << level) - 1
+        inside = (xs >= -reach) & (xs < table.shape[1]) & \
+            (ys >= -reach) & (ys < table.shape[0])
+        values = table[np.clip(ys, 0, table.shape[0] - 1),
+                       np.clip(xs, 0, table.shape[1] - 1)]
+        return np.where(inside, values, 0).sum(axis=1)
+
+    def _score_poses(self, poses: np.ndarray,
+                     readings: np.ndarray) -> np.ndarray:
+        """Mean level 0 likelihood of a sweep taken from each pose,
+        interpolated between cells
+
+        Args:
+            poses (np.ndarray): (P, 3) poses as [x, y, direction in radians]
+            readings (np.ndarray): (N, 2) usable readings of the sweep
+
+        Returns:
+            np.ndarray: (P,) scores
+        """
+        from scipy.ndimage import map_coordinates
+
+        angles = poses[:, 2, None] + readings[None, :, 0]
+        xs = poses[:, 0, None] + np.cos(angles) * readings[:, 1]
+        ys = poses[:, 1, None] + np.sin(angles) * readings[:, 1]
+        values = map_coordinates(self.tables[0], [ys.ravel(), xs.ravel()],
+                                 order=1, mode='constant', cval=0.0)
+        return values.reshape(xs.shape).mean(axis=1)
+
+    def _uncertainty(self, x: float, y: float,
+                     dir_in_rad: float) -> Tuple[int, float]:
+        """Translation and rotation search radius dead reckoning calls for"""
+        if self._last is not None:
+            last_x, last_y, last_dir = self._last
+            self._travelled += math.hypot(x - last_x, y - last_y)
+            self._turned += abs((dir_in_rad - last_dir + math.pi) %
+                                (2 * math.pi) - math.pi)
+        first = self._last is None
+        self._last = (x, y, dir_in_rad)
+        if first:
+            return self.window, self.angle_window
+        window = min(self.window, 1 + int(self.drift * self._travelled))
+        angle_window = min(self.angle_window,
+                           self.angle_step + self.turn_drift * self._turned)
+        return window, angle_window
+
+    def match(self, position: Iterable[float], dir_in_rad: float,
+              readings: Iterable[Tuple[float, float]]) -> Optional[Pose]:
+        """Find the pose near the estimate that best explains a sweep
+
+        Args:
+            position (Iterable[float]): estimated position in the form of [x, y]
+            dir_in_rad (float): estimated direction in radians
+            readings (Iterable[Tuple[float, float]]): (angle relative to the
+                car in radians, distance in cells) pairs of one sweep
+
+        Returns:
+            Optional[Pose]: corrected pose, or None if the sweep could not be
+                matched confidently or the estimate is as good as any
+        """
+        x, y = position
+        window, angle_window = self._uncertainty(x, y, dir_in_rad)
+        if not self.tables:
+            return None
+        readings = self._usable(readings)
+        if len(readings) < self.min_points:
+            return None
+
+        n_angles = int(round(angle_window / self.angle_step))
+        dirs = dir_in_rad + self.angle_step * np.arange(-n_angles, n_angles + 1)
+        angles = dirs[:, None] + readings[None, :, 0]
+        sweeps = np.stack([
+            np.round(x + np.cos(angles) * readings[:, 1]),
+            np.round(y + np.sin(angles) * readings[:, 1])], axis=-1).astype(int)
+
+        top = self.levels - 1
+        size = 1 << top
+        grid = np.arange(-window, window + 1, size)
+        offsets = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+        heap = []
+        for a, cells in enumerate(sweeps):
+            for score, (dx, dy) in zip(self._score(top, cells, offsets),
+                                       offsets):
+                heap.append((-score, top, a, int(dx), int(dy)))
+        heapq.heapify(heap)
+
+        # branch and bound: the first level 0 candidate popped is optimal, and
+        # the search goes on for a distinct one scoring about as well. Poses
+        # within a cell and peak_angle of the best lie on the same peak.
+        peak_steps = max(1, int(round(self.peak_angle / self.angle_step)))
+        best = None
+        ambiguous = False
+        while heap:
+            neg_score, level, a, dx, dy = heapq.heappop(heap)
+            if best is not None and -neg_score < self.max_ambiguity * best[0]:
+                break
+            if level == 0:
+                if best is None:
+                    best = (-neg_score, a, dx, dy)
+                elif abs(a - best[1]) > peak_steps or \
+                        max(abs(dx - best[2]), abs(dy - best[3])) > 1:
+                    ambiguous = True
+                    break
+                continue
+            half = 1 << (level - 1)
+            children = np.array([(dx + i, dy + j)
+                                 for i in (0, half) for j in (0, half)
+                                 if dx + i <= window and dy + j <= window])
+            scores = self._score(level - 1, sweeps[a], children)
+            for score, (cx, cy) in zip(scores, children):
+                heapq.heappush(heap, (-score, level - 1, a, int(cx), int(cy)))
+        if best is None:
+            return None
+
+        score, a, dx, dy = best
+        if score / len(readings) < self.min_score or ambiguous:
+            return None
+        # a confident match, whether or not it moves the pose, bounds the
+        # drift again
+        self._travelled = self._turned = 0.0
+        # the search works on whole cells, the peak is refined between them
+        # and compared with the odometry pose at the same resolution
+        shifts = np.linspace(-0.5, 0.5, 5)
+        turns = self.angle_step * np.linspace(-0.5, 0.5, 3)
+        poses = np.stack(np.meshgrid(x + dx + shifts, y + dy + shifts,
+                                     dirs[a] + turns), axis=-1).reshape(-1, 3)
+        poses = np.vstack([[x, y, dir_in_rad], poses])
+        scores = self._score_poses(poses, readings)
+        refined = 1 + int(np.argmax(scores[1:]))
+        if scores[refined] < scores[0] + self.min_gain:
+            return None
+        best_x, best_y, best_dir = poses[refined]
+        pose = Pose(float(best_x), float(best_y),
+                    float(best_dir) % (2 * math.pi), float(scores[refined]))
+        self._last = (pose.x, pose.y, pose.dir)
+        return pose
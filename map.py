@@ -1,18 +1,135 @@
-from typing import Union, List, NamedTuple, Tuple
+from typing import Callable, Union, List, NamedTuple, Optional, Tuple
 
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter
 
 from astar import astar
 
 
-Ray = NamedTuple(
-    "Ray",
-    [
-        ('origin', Tuple[int, int]),
-        ('angle', float),
-        ('dist', int),
-    ])
+# widest views in cells printed by Mapper.__str__ and drawn by Mapper.plot
+STR_WIDTH = 120
+PLOT_WIDTH = 300
+
+
+def grow_box(box: Optional[Tuple[int, int, int, int]],
+             other: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+    """Smallest inclusive (min_x, max_x, min_y, max_y) box covering both"""
+    if box is None:
+        return other
+    return (min(box[0], other[0]), max(box[1], other[1]),
+            min(box[2], other[2]), max(box[3], other[3]))
+
+
+class Ray(NamedTuple):
+    origin: Tuple[int, int]
+    angle: float
+    dist: int
+    # agreement of the ultrasonic readings behind dist, 0 to 1
+    confidence: float = 1.0
+
+
+def _pool(child: np.ndarray, min_x: int, max_x: int, min_y: int, max_y: int,
+          reduce: np.ufunc, pad: float) -> np.ndarray:
+    """Reduce 2x2 blocks of child covering an inclusive parent cell box"""
+    block = child[2 * min_y:2 * max_y + 2, 2 * min_x:2 * max_x + 2]
+    height, width = (max_y - min_y + 1) * 2, (max_x - min_x + 1) * 2
+    if block.shape != (height, width):
+        # the last row or column of the child is odd, pad with the identity
+        padded = np.full((height, width), pad, dtype=child.dtype)
+        padded[:block.shape[0], :block.shape[1]] = block
+        block = padded
+    return reduce.reduce(reduce.reduce(
+        block.reshape(height // 2, 2, width // 2, 2), axis=3), axis=1)
+
+
+class OccupancyPyramid:
+    """Max- and min-pooled levels of an occupancy grid for box queries
+
+    Level k holds one cell per 2^k x 2^k block of the grid, the last level is
+    a single cell. The max level says whether a block has any FILLED cell (or
+    is all EMPTY), the min level whether it has any EMPTY cell. Box queries
+    read summed-area tables of the FILLED and EMPTY cells instead, which
+    count the cells of any box with four lookups whatever its size.
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.data = data
+        self.max_levels: List[np.ndarray] = [data]
+        self.min_levels: List[np.ndarray] = [data]
+        while self.max_levels[-1].shape != (1, 1):
+            height, width = self.max_levels[-1].shape
+            shape = ((height + 1) // 2 - 1, (width + 1) // 2 - 1)
+            self.max_levels.append(_pool(self.max_levels[-1], 0, shape[1], 0,
+                                         shape[0], np.maximum, -np.inf))
+            self.min_levels.append(_pool(self.min_levels[-1], 0, shape[1], 0,
+                                         shape[0], np.minimum, np.inf))
+        # cells of each kind above and left of every grid corner
+        height, width = data.shape
+        self.filled_sums = np.zeros((height + 1, width + 1), dtype=np.int32)
+        self.empty_sums = np.zeros((height + 1, width + 1), dtype=np.int32)
+        self._update_sums(0, 0)
+
+    @property
+    def levels(self) -> int:
+        return len(self.max_levels)
+
+    def update(self, min_x: int, max_x: int, min_y: int, max_y: int) -> None:
+        """Recompute the blocks covering an inclusive box of changed cells"""
+        self._update_sums(min_x, min_y)
+        for k in range(1, self.levels):
+            min_x, max_x, min_y, max_y = \
+                min_x // 2, max_x // 2, min_y // 2, max_y // 2
+            self.max_levels[k][min_y:max_y + 1, min_x:max_x + 1] = _pool(
+                self.max_levels[k - 1], min_x, max_x, min_y, max_y,
+                np.maximum, -np.inf)
+            self.min_levels[k][min_y:max_y + 1, min_x:max_x + 1] = _pool(
+                self.min_levels[k - 1], min_x, max_x, min_y, max_y,
+                np.minimum, np.inf)
+
+    def _update_sums(self, min_x: int, min_y: int) -> None:
+        """Recompute the sums of every corner below and right of a cell"""
+        for sums, value in ((self.filled_sums, Mapper.FILLED),
+                            (self.empty_sums, Mapper.EMPTY)):
+            block = self.data[min_y:, min_x:] == value
+            block = block.cumsum(0, dtype=np.int32).cumsum(1, dtype=np.int32)
+            sums[min_y + 1:, min_x + 1:] = block + \
+                sums[min_y, min_x + 1:][None, :] + \
+                sums[min_y + 1:, min_x][:, None] - sums[min_y, min_x]
+
+    def _count(self, min_x: int, max_x: int, min_y: int, max_y: int
+               ) -> Optional[Tuple[int, int, int]]:
+        """FILLED, EMPTY and all cells in an inclusive box clipped to the
+        grid, None if nothing of it is on the grid"""
+        height, width = self.data.shape
+        min_x, min_y = max(int(min_x), 0), max(int(min_y), 0)
+        max_x, max_y = min(int(max_x), width - 1), min(int(max_y), height - 1)
+        if min_x > max_x or min_y > max_y:
+            return None
+        counts = [int(sums[max_y + 1, max_x + 1] - sums[min_y, max_x + 1] -
+                      sums[max_y + 1, min_x] + sums[min_y, min_x])
+                  for sums in (self.filled_sums, self.empty_sums)]
+        return counts[0], counts[1], (max_x - min_x + 1) * (max_y - min_y + 1)
+
+    def box_max(self, min_x: int, max_x: int, min_y: int, max_y: int
+                ) -> Optional[float]:
+        """Largest value in an inclusive box, None if the box is off the grid"""
+        counts = self._count(min_x, max_x, min_y, max_y)
+        if counts is None:
+            return None
+        filled, empty, cells = counts
+        if filled:
+            return Mapper.FILLED
+        return Mapper.EMPTY if empty == cells else Mapper.UNKNOWN
+
+    def box_min(self, min_x: int, max_x: int, min_y: int, max_y: int
+                ) -> Optional[float]:
+        """Smallest value in an inclusive box, None if the box is off the grid"""
+        counts = self._count(min_x, max_x, min_y, max_y)
+        if counts is None:
+            return None
+        filled, empty, cells = counts
+        if empty:
+            return Mapper.EMPTY
+        return Mapper.FILLED if filled == cells else Mapper.UNKNOWN
 
 
 class Mapper:
@@ -22,16 +139,27 @@ class Mapper:
     UNKNOWN = 1
     FILLED = 2
 
-    def __init__(self, size=100, dist_cutoff=8, connect_cutoff=5):
+    def __init__(self, size=100, dist_cutoff=8, connect_cutoff=5,
+                 min_confidence=0.5):
         self.size = size
         self.dist_cutoff = dist_cutoff
         self.connect_cutoff = connect_cutoff
+        # rays less confident than this only clear space, never add walls
+        self.min_confidence = min_confidence
         self.data = np.ones((size, size)) * Mapper.UNKNOWN
         self.rays = []
+        # inclusive (min_x, max_x, min_y, max_y) box of cells changed since
+        # the last call to pop_dirty
+        self.dirty: Optional[Tuple[int, int, int, int]] = None
+        self._pyramid = OccupancyPyramid(self.data)
+        # cells changed since the pyramid was last brought up to date
+        self._stale: Optional[Tuple[int, int, int, int]] = None
+        self._listeners: List[Callable[[int, int, int, int], None]] = []
 
     def add_ray(self, ray: Ray) -> None:
         x, y = np.array(ray.origin).round().astype(int)
         self.data[y, x] = 0
+        self.mark_dirty(x, x, y, y)
         if self.rays:
             last_ray = self.rays[-1]
             last_ray_end = (last_ray.origin[0] + np.cos(last_ray.angle) * last_ray.dist,
@@ -45,7 +173,9 @@ class Mapper:
             if end_point_dist < self.connect_cutoff:
                 self.shade_triangle(
                     last_ray.origin, this_ray_end, last_ray_end)
-                if max(ray.dist, last_ray.dist) < self.dist_cutoff:
+                if max(ray.dist, last_ray.dist) < self.dist_cutoff and \
+                        min(ray.confidence, last_ray.confidence) >= \
+                        self.min_confidence:
                     self.draw_line(this_ray_end, last_ray_end)
         self.rays.append(ray)
 
@@ -60,6 +190,7 @@ class Mapper:
         max_x = np.ceil(max(p1[0], p2[0], p3[0])).astype(int)
         min_y = np.floor(min(p1[1], p2[1], p3[1])).astype(int)
         max_y = np.ceil(max(p1[1], p2[1], p3[1])).astype(int)
+        min_x, max_x, min_y, max_y = self._clip(min_x, max_x, min_y, max_y)
 
         # Check each point in the bounding box
         for x in range(min_x, max_x + 1):
@@ -68,6 +199,7 @@ class Mapper:
                 inside = self.is_inside_triangle(p1, p2, p3, (x, y))
                 if inside:
                     self.data[y, x] = Mapper.EMPTY
+        self.mark_dirty(min_x, max_x, min_y, max_y)
 
     def is_inside_triangle(self, p1, p2, p3, p) -> bool:
         """Check if a point is inside a triangle"""
@@ -97,6 +229,7 @@ class Mapper:
         max_x = np.ceil(max(p1[0], p2[0])).astype(int)
         min_y = np.floor(min(p1[1], p2[1])).astype(int)
         max_y = np.ceil(max(p1[1], p2[1])).astype(int)
+        min_x, max_x, min_y, max_y = self._clip(min_x, max_x, min_y, max_y)
 
         # Check each point in the bounding box
         for x in range(min_x, max_x + 1):
@@ -104,30 +237,104 @@ class Mapper:
                 # Check if the point is on the line
                 if self.is_on_line(p1, p2, (x, y)):
                     self.data[y, x] = Mapper.FILLED
+        self.mark_dirty(min_x, max_x, min_y, max_y)
 
     def is_on_line(self, p1, p2, p) -> bool:
         """Check if a point is on a line"""
         return np.linalg.norm(np.cross(p2 - p1, p1 - p)) / np.linalg.norm(p2 - p1) < 0.5
 
+    def _clip(self, min_x: int, max_x: int, min_y: int,
+              max_y: int) -> Tuple[int, int, int, int]:
+        """Clip an inclusive bounding box to the grid, negative indices would
+        wrap around to the other side"""
+        return (max(int(min_x), 0), min(int(max_x), self.data.shape[1] - 1),
+                max(int(min_y), 0), min(int(max_y), self.data.shape[0] - 1))
+
+    def mark_dirty(self, min_x: int, max_x: int, min_y: int, max_y: int) -> None:
+        """Grow the dirty region to cover the given inclusive bounding box"""
+        min_x, max_x, min_y, max_y = self._clip(min_x, max_x, min_y, max_y)
+        if min_x > max_x or min_y > max_y:
+            return
+        self.dirty = grow_box(self.dirty, (min_x, max_x, min_y, max_y))
+        self._stale = grow_box(self._stale, (min_x, max_x, min_y, max_y))
+        for listener in self._listeners:
+            listener(min_x, max_x, min_y, max_y)
+
+    def set_data(self, data: np.ndarray) -> None:
+        """Replace the whole grid, e.g. with a map of an earlier run"""
+        self.data[:] = data
+        self.mark_dirty(0, self.data.shape[1] - 1, 0, self.data.shape[0] - 1)
+
+    def add_listener(self,
+                     listener: Callable[[int, int, int, int], None]) -> None:
+        """Call listener with the inclusive (min_x, max_x, min_y, max_y) box
+        of cells whenever they change"""
+        self._listeners.append(listener)
+
+    def pop_dirty(self) -> Optional[Tuple[int, int, int, int]]:
+        """Return the region changed since the last call and reset it
+
+        Returns:
+            Optional[Tuple[int, int, int, int]]: inclusive (min_x, max_x,
+                min_y, max_y) box, or None if nothing changed
+        """
+        dirty, self.dirty = self.dirty, None
+        return dirty
+
+    @property
+    def pyramid(self) -> OccupancyPyramid:
+        """The occupancy pyramid, brought up to date with the grid"""
+        if self._stale is not None:
+            self._pyramid.update(*self._stale)
+            self._stale = None
+        return self._pyramid
+
+    def any_filled(self, min_x: int, max_x: int, min_y: int,
+                   max_y: int) -> bool:
+        """Whether any cell in the inclusive box is an obstacle"""
+        return self.pyramid.box_max(min_x, max_x, min_y, max_y) == \
+            Mapper.FILLED
+
+    def all_empty(self, min_x: int, max_x: int, min_y: int,
+                  max_y: int) -> bool:
+        """Whether every cell in the inclusive box is known to be free"""
+        return self.pyramid.box_max(min_x, max_x, min_y, max_y) == \
+            Mapper.EMPTY
+
+    def view(self, level: int) -> np.ndarray:
+        """The grid at 1 / 2^level resolution
+
+        A cell is FILLED if its block has an obstacle, EMPTY if the whole
+        block is free and UNKNOWN otherwise.
+        """
+        return self.pyramid.max_levels[level]
+
+    def level_for(self, max_cells: int) -> int:
+        """Finest level whose view is at most max_cells wide"""
+        level = 0
+        while self.pyramid.max_levels[level].shape[1] > max_cells:
+            level += 1
+        return level
+
     def __str__(self) -> str:
-        s = ''
-        for row in self.data:
-            for block in row:
-                if block == Mapper.EMPTY:
-                    s += ' '
-                elif block == Mapper.UNKNOWN:
-                    s += '▓'
-                elif block == Mapper.FILLED:
-                    s += '█'
-            s += '\n'
-        return s
+        chars = np.array([' ', '▓', '█'])
+        view = self.view(self.level_for(STR_WIDTH)).astype(int)
+        return ''.join(''.join(row) + '\n' for row in chars[view])
 
     def plot(self, path=Union[None, List[Tuple[int, int]]],
              show=True, save_file=None) -> None:
         import matplotlib.pyplot as plt
 
         plt.figure(dpi=400)
-        plt.pcolormesh(self.data, cmap='Greys')
+        # a few hundred cells across are as many as the figure can show
+        level = self.level_for(PLOT_WIDTH)
+        view = self.view(level)
+        edges_x = np.minimum(np.arange(view.shape[1] + 1) << level,
+                             self.data.shape[1])
+        edges_y = np.minimum(np.arange(view.shape[0] + 1) << level,
+                             self.data.shape[0])
+        plt.pcolormesh(edges_x, edges_y, view, cmap='Greys',
+                       vmin=Mapper.EMPTY, vmax=Mapper.FILLED)
         for ray in self.rays[-5:]:
             x, y = ray.origin
             dx = np.cos(ray.angle) * ray.dist
@@ -151,17 +358,31 @@ class Mapper:
         if show:
             plt.show()
 
-    def route(self, start: Tuple[int, int], dest: Tuple[int, int]) -> List[Tuple[int, int]]:
-        """Find a route from start to dest"""
-        obstacle_map = (self.data == self.FILLED).astype(float)
-        blurred = gaussian_filter(obstacle_map, sigma=1)
-        threshold = blurred[start[1], start[0]]
-        extruded = (blurred >= max(threshold, 0.01)).astype(int)
+    def plot_obstacles(self, start: Tuple[int, int]) -> None:
+        """Plot the inflated obstacle map routes are planned on"""
         import matplotlib.pyplot as plt
-        plt.pcolormesh(extruded, cmap='Greys')
+        plt.pcolormesh(inflate_obstacles(self.data, start), cmap='Greys')
         plt.show()
-        return astar(extruded.T, start, dest)
-        # return astar((self.data == self.FILLED).astype(int).T, start, dest)
+
+    def route(self, start: Tuple[int, int], dest: Tuple[int, int]) -> List[Tuple[int, int]]:
+        """Find a route from start to dest"""
+        return find_route(self.data, start, dest)
+
+
+def inflate_obstacles(data: np.ndarray, start: Tuple[int, int]) -> np.ndarray:
+    """Blur filled cells into a binary obstacle map that leaves start free"""
+    from scipy.ndimage import gaussian_filter
+
+    obstacle_map = (data == Mapper.FILLED).astype(float)
+    blurred = gaussian_filter(obstacle_map, sigma=1)
+    threshold = blurred[start[1], start[0]]
+    return (blurred >= max(threshold, 0.01)).astype(int)
+
+
+def find_route(data: np.ndarray, start: Tuple[int, int],
+               dest: Tuple[int, int]) -> Optional[List[Tuple[int, int]]]:
+    """Find a route from start to dest on a map grid without plotting"""
+    return astar(inflate_obstacles(data, start).T, start, dest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,301 @@
+"""Align and merge occupancy grids of different runs in the same space
+
+The moving grid is rotated over a coarse set of angles and every rotation is
+cross-correlated with the fixed grid at all translations at once with an FFT
+on block-averaged copies of both. The best coarse candidates are refined with
+small rotation steps at full resolution, only accepting translations near
+the coarse estimate.
+
+Obstacles of the fixed grid are blurred by a cell, so small drift between
+the runs still lines walls up. Obstacles landing on free space and free space
+landing on obstacles count against a placement.
+"""
+import argparse
+import math
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from map import Mapper
+
+
+# weight of free space agreement next to obstacle agreement
+FREE_WEIGHT = 0.25
+# largest score given up for a placement that moves the grid less
+TIE_BREAK = 0.02
+
+
+class Alignment(NamedTuple):
+    # degrees the moving grid is rotated by, as by scipy.ndimage.rotate
+    angle: float
+    # cell of the fixed grid the top left corner of the rotated moving grid
+    # lands on, may be negative
+    dx: int
+    dy: int
+    # agreement of the overlapping known cells, at most 1, relative to the
+    # grid with fewer of them
+    score: float
+
+
+def _rotate(data: np.ndarray, angle: float) -> np.ndarray:
+    """Rotate a grid about its center, growing it to keep every cell"""
+    from scipy.ndimage import rotate
+
+    if angle % 360 == 0:
+        return data
+    return rotate(data, angle, reshape=True, order=0, mode='constant',
+                  cval=Mapper.UNKNOWN)
+
+
+def _pool(image: np.ndarray, factor: int) -> np.ndarray:
+    """Average factor x factor blocks, padding the edges with zeros"""
+    if factor == 1:
+        return image
+    height = -(-image.shape[0] // factor) * factor
+    width = -(-image.shape[1] // factor) * factor
+    padded = np.zeros((height, width))
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded.reshape(height // factor, factor, width // factor,
+                          factor).mean(axis=(1, 3))
+
+
+class _Correlator:
+    """FFT of the fixed grid's features, reused for every rotation"""
+
+    def __init__(self, fixed: np.ndarray, factor: int, max_shape: int):
+        from scipy.ndimage import gaussian_filter
+
+        filled = gaussian_filter((fixed == Mapper.FILLED).astype(float), 1)
+        filled = np.minimum(filled / filled.max(), 1) if filled.any() \
+            else filled
+        empty = (fixed == Mapper.EMPTY).astype(float)
+        self.factor = factor
+        self.shape = _pool(filled, factor).shape
+        self.total = (fixed == Mapper.FILLED).sum() + FREE_WEIGHT * empty.sum()
+        size = max_shape // factor + 2
+        self.fft_shape = (self.shape[0] + size, self.shape[1] + size)
+        self._filled = np.fft.rfft2(_pool(filled - empty, factor),
+                                    self.fft_shape)
+        self._empty = np.fft.rfft2(_pool(empty - filled, factor),
+                                   self.fft_shape)
+
+    def correlate(self, moving: np.ndarray) -> Tuple[np.ndarray, np.ndarray,
+                                                      np.ndarray]:
+        """Score of every translation of an already rotated moving grid
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: normalized scores and
+                the x and y translation in pooled cells of each of them
+        """
+        filled = _pool((moving == Mapper.FILLED).astype(float), self.factor)
+        empty = _pool((moving == Mapper.EMPTY).astype(float), self.factor)
+        # relative to the smaller grid, a single sweep can match a whole map
+        total = min((filled.sum() + FREE_WEIGHT * empty.sum()) *
+                    self.factor ** 2, self.total) / self.factor ** 2
+        spectrum = \
+            self._filled * np.conj(np.fft.rfft2(filled, self.fft_shape)) + \
+            FREE_WEIGHT * self._empty * \
+            np.conj(np.fft.rfft2(empty, self.fft_shape))
+        scores = np.fft.irfft2(spectrum, self.fft_shape) / max(total, 1e-9)
+        # index i holds the translation i, or i - size once it wraps around
+        ty = np.arange(self.fft_shape[0])
+        tx = np.arange(self.fft_shape[1])
+        ty = np.where(ty < self.shape[0], ty, ty - self.fft_shape[0])
+        tx = np.where(tx < self.shape[1], tx, tx - self.fft_shape[1])
+        return scores, tx, ty
+
+
+def _best_placement(scores: np.ndarray, tx: np.ndarray, ty: np.ndarray,
+                    scale: int, shape: Tuple[int, int],
+                    center: Tuple[float, float], radius: float
+                    ) -> Optional[Tuple[float, float, float]]:
+    """Best score whose placement keeps the rotated grid's center within
+    radius of center
+
+    Returns:
+        Optional[Tuple[float, float, float]]: the score and the center of the
+            rotated grid in fixed cells, or None if nothing is in reach
+    """
+    center_x = tx * scale + shape[1] / 2
+    center_y = ty * scale + shape[0] / 2
+    near_x = np.abs(center_x - center[0]) <= radius
+    near_y = np.abs(center_y - center[1]) <= radius
+    if not near_x.any() or not near_y.any():
+        return None
+    window = scores[np.ix_(near_y, near_x)]
+    iy, ix = np.unravel_index(np.argmax(window), window.shape)
+    return (float(window[iy, ix]), float(center_x[near_x][ix]),
+            float(center_y[near_y][iy]))
+
+
+def align(fixed: np.ndarray, moving: np.ndarray,
+          angle_range: float = 180.0, max_shift: Optional[float] = None,
+          coarse_step: float = 10.0, fine_step: float = 1.0, factor: int = 4,
+          candidates: int = 3) -> Alignment:
+    """Find the rotation and translation that best lays moving onto fixed
+
+    Args:
+        fixed (np.ndarray): the grid to align to
+        moving (np.ndarray): the grid to align
+        angle_range (float, optional): search angles within this many
+            degrees either way. Defaults to 180.0.
+        max_shift (Optional[float], optional): if the grids share roughly
+            the same origin, the furthest in cells the center of moving may
+            move. Among equally good placements the least moved one wins,
+            which a single sweep of a mostly open room needs. Defaults to
+            None, searching every translation.
+        coarse_step (float, optional): degrees between the angles of the
+            coarse search. Defaults to 10.0.
+        fine_step (float, optional): degrees between the angles of the
+            refinement. Defaults to 1.0.
+        factor (int, optional): cells per block of the coarse search.
+            Defaults to 4.
+        candidates (int, optional): coarse results that get refined.
+            Defaults to 3.
+
+    Returns:
+        Alignment: the best placement of the moving grid
+    """
+    max_shape = int(math.ceil(math.hypot(*moving.shape))) + 2
+    coarse = _Correlator(fixed, factor, max_shape)
+    fine = _Correlator(fixed, 1, max_shape)
+    origin = (moving.shape[1] / 2, moving.shape[0] / 2)
+    reach = math.inf if max_shift is None else max_shift
+
+    def penalty(angle: float, center_x: float, center_y: float) -> float:
+        if max_shift is None:
+            return 0.0
+        moved = math.hypot(center_x - origin[0], center_y - origin[1])
+        return TIE_BREAK * (moved / max(max_shift, 1) +
+                            abs(angle) / max(angle_range, 1))
+
+    # coarse search, keep the center of the best placement of each angle
+    found: List[Tuple[float, float, float, float]] = []
+    steps = int(angle_range // coarse_step)
+    angles = np.arange(-steps, steps + 1) * coarse_step
+    # -180 and 180 are the same rotation
+    for angle in angles[angles > -180]:
+        rotated = _rotate(moving, angle)
+        placement = _best_placement(*coarse.correlate(rotated), factor,
+                                    rotated.shape, origin, reach + factor)
+        if placement is not None:
+            score, center_x, center_y = placement
+            found.append((score - penalty(angle, center_x, center_y),
+                          angle, center_x, center_y))
+    found.sort(reverse=True)
+
+    best, best_score = Alignment(0.0, 0, 0, -math.inf), -math.inf
+    for _, coarse_angle, coarse_x, coarse_y in found[:candidates]:
+        for angle in coarse_angle + np.arange(
+                -coarse_step + fine_step, coarse_step, fine_step):
+            if abs(angle) > angle_range:
+                continue
+            rotated = _rotate(moving, angle)
+            scores, tx, ty = fine.correlate(rotated)
+            # only translations that keep the center near the coarse one
+            if max_shift is not None:
+                scores = scores.copy()
+                far = np.hypot(
+                    (tx + rotated.shape[1] / 2 - origin[0])[None],
+                    (ty + rotated.shape[0] / 2 - origin[1])[:, None]) > \
+                    max_shift
+                scores[far] = -np.inf
+            placement = _best_placement(scores, tx, ty, 1, rotated.shape,
+                                        (coarse_x, coarse_y), 2 * factor)
+            if placement is None:
+                continue
+            score, center_x, center_y = placement
+            adjusted = score - penalty(angle, center_x, center_y)
+            if adjusted > best_score:
+                best_score = adjusted
+                best = Alignment(
+                    float(angle), int(round(center_x - rotated.shape[1] / 2)),
+                    int(round(center_y - rotated.shape[0] / 2)), score)
+    return best
+
+
+def transform(moving: np.ndarray, alignment: Alignment,
+              shape: Tuple[int, int]) -> np.ndarray:
+    """Resample the moving grid into the frame of the fixed grid
+
+    Args:
+        moving (np.ndarray): the grid that was aligned
+        alignment (Alignment): its placement
+        shape (Tuple[int, int]): shape of the fixed grid
+
+    Returns:
+        np.ndarray: grid of the given shape, UNKNOWN where moving has no cell
+    """
+    rotated = _rotate(moving, alignment.angle)
+    out = np.full(shape, Mapper.UNKNOWN, dtype=moving.dtype)
+    x0, y0 = max(alignment.dx, 0), max(alignment.dy, 0)
+    x1 = min(alignment.dx + rotated.shape[1], shape[1])
+    y1 = min(alignment.dy + rotated.shape[0], shape[0])
+    if x0 < x1 and y0 < y1:
+        out[y0:y1, x0:x1] = rotated[y0 - alignment.dy:y1 - alignment.dy,
+                                    x0 - alignment.dx:x1 - alignment.dx]
+    return out
+
+
+def merge(fixed: np.ndarray, moving: np.ndarray, alignment: Alignment,
+          moving_wins: bool = False) -> np.ndarray:
+    """Combine the known cells of two aligned grids in the fixed frame
+
+    Args:
+        fixed (np.ndarray): the grid that was aligned to
+        moving (np.ndarray): the grid that was aligned
+        alignment (Alignment): placement of moving
+        moving_wins (bool, optional): where both grids know a cell, take the
+            moving grid's, e.g. when it is the newer run. Defaults to False.
+
+    Returns:
+        np.ndarray: the merged grid, shaped like fixed
+    """
+    placed = transform(moving, alignment, fixed.shape)
+    if moving_wins:
+        return np.where(placed != Mapper.UNKNOWN, placed, fixed)
+    return np.where(fixed != Mapper.UNKNOWN, fixed, placed)
+
+
+def pad(data: np.ndarray, cells: int) -> np.ndarray:
+    """Surround a grid with UNKNOWN cells to make room for a merge"""
+    return np.pad(data, cells, mode='constant',
+                  constant_values=Mapper.UNKNOWN)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('stored', help='Map to merge into, a saved .npy grid.')
+    parser.add_argument('new', help='Map of the new run, a saved .npy grid.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Save the merged grid here, defaults to stored.')
+    parser.add_argument('--pad', type=int, default=0,
+                        help='Unknown cells added around the stored map.')
+    parser.add_argument('--angleRange', type=float, default=180.0,
+                        help='Search rotations within this many degrees.')
+    parser.add_argument('--minScore', type=float, default=0.3,
+                        help='Refuse to merge alignments scoring lower.')
+    parser.add_argument('--plot', action='store_true',
+                        help='Show the merged map.')
+    args = parser.parse_args()
+
+    stored = pad(np.load(args.stored), args.pad)
+    new = np.load(args.new)
+    alignment = align(stored, new, angle_range=args.angleRange)
+    print(f'angle: {alignment.angle:.1f} degrees  offset: '
+          f'({alignment.dx}, {alignment.dy})  score: {alignment.score:.2f}')
+    if alignment.score < args.minScore:
+        raise SystemExit('Alignment too poor to merge')
+    merged = merge(stored, new, alignment, moving_wins=True)
+    np.save(args.output or args.stored, merged)
+    if args.plot:
+        import matplotlib.pyplot as plt
+        plt.pcolormesh(merged, cmap='Greys', vmin=Mapper.EMPTY,
+                       vmax=Mapper.FILLED)
+        plt.gca().set_aspect('equal')  # type: ignore
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
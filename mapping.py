@@ -1,36 +1,42 @@
+import argparse
 import math
 import time
+from typing import Optional
 
 import picar_4wd as fc
 
 from map import Mapper, Ray
 from common import Radar, Car
+from recorder import Recorder, RecordingBackend
 
 
-def main():
+def main(recorder: Optional[Recorder] = None):
     MAP_SIZE = 600
+    hw = RecordingBackend(fc, recorder) if recorder is not None else None
     mapper = Mapper(size=MAP_SIZE, dist_cutoff=7, connect_cutoff=7)
-    radar = Radar()
+    radar = Radar(hw=hw, burst_samples=5)
     car = Car(position=(MAP_SIZE // 2, MAP_SIZE // 2),
-              dir_in_rad=math.radians(90))
+              dir_in_rad=math.radians(90), hw=hw)
 
     # initial scan
     for _ in range(15):
-        angle, dist = radar.scan_step()
+        angle, dist, confidence = radar.scan_step()
         angle_in_rad = math.radians(-angle) + car.curr_dir
         angle_in_rad %= (2 * math.pi)
         position = car.get_position().round().astype(int)
-        ray = Ray(tuple(position), angle_in_rad, round(dist / 4))
+        ray = Ray(tuple(position), angle_in_rad, round(dist / 4), confidence)
         mapper.add_ray(ray)
 
     start_time = time.monotonic()
     while True:
         car.forward()
-        angle, dist = radar.scan_step()
+        angle, dist, confidence = radar.scan_step()
         angle_in_rad = math.radians(-angle) + car.curr_dir
         angle_in_rad %= (2 * math.pi)
         position = car.get_position().round().astype(int)
-        ray = Ray(tuple(position), angle_in_rad, round(dist / 4))
+        if recorder is not None:
+            recorder.pose(car.get_position(), car.curr_dir)
+        ray = Ray(tuple(position), angle_in_rad, round(dist / 4), confidence)
         mapper.add_ray(ray)
 
         if time.monotonic() - start_time > 5:
@@ -44,7 +50,19 @@ def main():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-r', '--record',
+        help='Save a log of the run to this .npz file',
+        required=False,
+        default=None)
+    args = parser.parse_args()
+
+    recorder = Recorder() if args.record else None
     try:
-        main()
+        main(recorder)
     finally:
         fc.stop()
+        if recorder is not None:
+            recorder.save(args.record)
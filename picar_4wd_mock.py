@@ -21,6 +21,18 @@ def stop():
     pass
 
 
+class MockMotor:
+    def set_power(self, power):
+        # print("Motor set power", power)
+        pass
+
+
+left_front = MockMotor()
+left_rear = MockMotor()
+right_front = MockMotor()
+right_rear = MockMotor()
+
+
 class MockUS:
     def get_distance(self):
         return 30 + random.randint(0, 50)
@@ -0,0 +1,146 @@
+"""Plan routes in a worker process while the car keeps driving"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from map import Mapper, find_route
+
+
+Path = List[Tuple[int, int]]
+Reply = Tuple[int, Tuple[int, int], Optional[Path]]
+
+
+def _plan_worker(shm_name: str, shape: Tuple[int, int], dtype: str,
+                 lock, conn) -> None:
+    """Answer route requests against the map held in shared memory"""
+    # import while idle so the first request does not pay for it
+    import scipy.ndimage  # noqa: F401
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    grid = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        while True:
+            request = conn.recv()
+            # only the newest pending request is worth planning for
+            while request is not None and conn.poll():
+                request = conn.recv()
+            if request is None:
+                break
+            request_id, start, dest = request
+            with lock:
+                data = grid.copy()
+            conn.send((request_id, start, find_route(data, start, dest)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del grid
+        shm.close()
+
+
+class Planner:
+    """Run `find_route` in a separate process on a shared copy of the map
+
+    Changes made to the mapper are copied into shared memory as deltas (the
+    mapper's dirty region) every time a route is requested, so the worker
+    never needs the whole grid pickled across.
+    """
+
+    def __init__(self, mapper: Mapper):
+        self.mapper = mapper
+        data = mapper.data
+        self._shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        self._grid = np.ndarray(data.shape, dtype=data.dtype,
+                                buffer=self._shm.buf)
+        self._grid[:] = data
+        mapper.pop_dirty()
+
+        self._lock = mp.Lock()
+        self._conn, child_conn = mp.Pipe()
+        self._process = mp.Process(
+            target=_plan_worker,
+            args=(self._shm.name, data.shape, data.dtype.str,
+                  self._lock, child_conn),
+            daemon=True)
+        self._process.start()
+        child_conn.close()
+
+        self._request_id = 0
+
+    def publish(self) -> None:
+        """Copy the cells changed since the last publish into shared memory"""
+        dirty = self.mapper.pop_dirty()
+        if dirty is None:
+            return
+        min_x, max_x, min_y, max_y = dirty
+        with self._lock:
+            self._grid[min_y:max_y + 1, min_x:max_x + 1] = \
+                self.mapper.data[min_y:max_y + 1, min_x:max_x + 1]
+
+    def request(self, start: Iterable[int], dest: Iterable[int]) -> int:
+        """Publish the latest map and ask the worker for a route
+
+        Args:
+            start (Iterable[int]): start cell in the form of [x, y]
+            dest (Iterable[int]): destination cell in the form of [x, y]
+
+        Returns:
+            int: id of the request, increasing with every call
+        """
+        self.publish()
+        self._request_id += 1
+        start = tuple(int(v) for v in start)
+        dest = tuple(int(v) for v in dest)
+        self._conn.send((self._request_id, start, dest))
+        return self._request_id
+
+    def poll(self) -> Optional[Reply]:
+        """Return the freshest route received so far without blocking
+
+        Returns:
+            Optional[Reply]: (request id, start, path) or None if nothing
+                new has arrived. Older replies are dropped.
+        """
+        reply = None
+        while self._conn.poll():
+            reply = self._conn.recv()
+        return reply
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Path]:
+        """Block until the route for the latest request arrives
+
+        Args:
+            timeout (Optional[float], optional): seconds to wait. Defaults to
+                None which waits forever.
+
+        Returns:
+            Optional[Path]: the route, or None if no route exists or the
+                timeout expired
+        """
+        while self._conn.poll(timeout):
+            request_id, _start, path = self._conn.recv()
+            if request_id == self._request_id:
+                return path
+        return None
+
+    def close(self) -> None:
+        """Stop the worker and release the shared memory"""
+        if self._process.is_alive():
+            try:
+                self._conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+        del self._grid
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self) -> 'Planner':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
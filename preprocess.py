@@ -0,0 +1,87 @@
+"""Turn raw camera frames into object detection model input"""
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class FramePreprocessor:
+    """Turn camera frames into model input with as few copies as possible.
+
+    The region of interest is cropped as a view of the raw frame, resized to the
+    model input size into a reused buffer, and then flipped upside down, mirrored
+    and converted from BGR to RGB in a single strided copy into another reused
+    buffer. Only the pixels the model sees are ever flipped or converted.
+    """
+
+    def __init__(self,
+                 input_size: Optional[Tuple[int, int]] = None,
+                 roi: Optional[Tuple[float, float, float, float]] = None) -> None:
+        """Configures the preprocessing.
+
+        Args:
+          input_size: (width, height) to resize to, or None to keep the region
+            of interest at camera resolution.
+          roi: (x, y, width, height) of the region of interest as fractions of
+            the flipped frame, or None for the whole frame.
+        """
+        self.input_size = input_size
+        self.roi = roi if roi is not None else (0.0, 0.0, 1.0, 1.0)
+        self._frame_shape: Optional[Tuple[int, ...]] = None
+        self._box = (0, 0, 0, 0)
+        self._resized: Optional[np.ndarray] = None
+        self._rgb: Optional[np.ndarray] = None
+
+    def _allocate(self, shape: Tuple[int, ...]) -> None:
+        height, width = shape[:2]
+        x, y, w, h = self.roi
+        x0, y0 = int(round(x * width)), int(round(y * height))
+        x1 = min(width, x0 + max(1, int(round(w * width))))
+        y1 = min(height, y0 + max(1, int(round(h * height))))
+        self._box = (x0, y0, x1, y1)
+        if self.input_size is not None:
+            out_w, out_h = self.input_size
+            self._resized = np.empty((out_h, out_w, 3), dtype=np.uint8)
+        else:
+            out_w, out_h = x1 - x0, y1 - y0
+            self._resized = None
+        self._rgb = np.empty((out_h, out_w, 3), dtype=np.uint8)
+        self._frame_shape = shape
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        """Preprocesses a raw BGR camera frame.
+
+        Args:
+          image: The frame as read from the camera.
+
+        Returns:
+          The RGB model input. The buffer is reused by the next call.
+        """
+        if image.shape != self._frame_shape:
+            self._allocate(image.shape)
+        height, width = image.shape[:2]
+        x0, y0, x1, y1 = self._box
+
+        # the region of interest of the flipped frame, taken from the raw one
+        crop = image[height - y1:height - y0, width - x1:width - x0]
+        if self._resized is not None:
+            crop = cv2.resize(crop, self.input_size, dst=self._resized,
+                              interpolation=cv2.INTER_AREA)
+
+        # flip both axes and swap BGR to RGB in one pass
+        np.copyto(self._rgb, crop[::-1, ::-1, ::-1])
+        return self._rgb
+
+    def to_frame(self, x: float, y: float) -> Tuple[float, float]:
+        """Maps a point of the model input back onto the flipped frame.
+
+        Args:
+          x: Horizontal coordinate in model input pixels.
+          y: Vertical coordinate in model input pixels.
+
+        Returns:
+          The point in flipped camera frame pixels.
+        """
+        x0, y0, x1, y1 = self._box
+        out_h, out_w = self._rgb.shape[:2]
+        return (x0 + x * (x1 - x0) / out_w, y0 + y * (y1 - y0) / out_h)
@@ -0,0 +1,158 @@
+"""Record sensor readings, motor commands, poses and detections of a run
+
+Every stream is a NumPy structured array of fixed size records, grown in
+place and saved together as one .npz file.
+"""
+import time
+from typing import Dict, Iterable
+
+import numpy as np
+
+
+RADAR_DTYPE = np.dtype([('t', 'f8'), ('angle', 'f4'), ('dist', 'f4')])
+MOTOR_DTYPE = np.dtype([('t', 'f8'), ('left', 'f4'), ('right', 'f4')])
+POSE_DTYPE = np.dtype([('t', 'f8'), ('x', 'f4'), ('y', 'f4'), ('dir', 'f4')])
+DETECTION_DTYPE = np.dtype([('t', 'f8'), ('stop_sign', '?')])
+
+
+class _Stream:
+    """Append-only structured array with amortized growth"""
+
+    def __init__(self, dtype: np.dtype, capacity: int = 1024):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, record: tuple) -> None:
+        if self.size == len(self.buffer):
+            self.buffer = np.resize(self.buffer, 2 * len(self.buffer))
+        self.buffer[self.size] = record
+        self.size += 1
+
+    @property
+    def data(self) -> np.ndarray:
+        return self.buffer[:self.size]
+
+
+class Recorder:
+    """Collect the streams of a run, timestamped with the given clock"""
+
+    def __init__(self, clock=None):
+        """
+        Args:
+            clock (optional): object providing monotonic. Defaults to the time
+                module.
+        """
+        self.clock = clock if clock is not None else time
+        self.streams = {
+            'radar': _Stream(RADAR_DTYPE),
+            'motor': _Stream(MOTOR_DTYPE),
+            'pose': _Stream(POSE_DTYPE),
+            'detection': _Stream(DETECTION_DTYPE),
+        }
+
+    def radar(self, angle: float, dist: float) -> None:
+        self.streams['radar'].append((self.clock.monotonic(), angle, dist))
+
+    def motor(self, left: float, right: float) -> None:
+        self.streams['motor'].append((self.clock.monotonic(), left, right))
+
+    def pose(self, position: Iterable[float], dir_in_rad: float) -> None:
+        x, y = position
+        self.streams['pose'].append((self.clock.monotonic(), x, y, dir_in_rad))
+
+    def detection(self, stop_sign: bool) -> None:
+        self.streams['detection'].append((self.clock.monotonic(), stop_sign))
+
+    def save(self, path: str) -> None:
+        """Write all streams to a single .npz file"""
+        np.savez(path, **{name: stream.data
+                          for name, stream in self.streams.items()})
+
+
+def load(path: str) -> Dict[str, np.ndarray]:
+    """Load the streams saved by Recorder.save"""
+    with np.load(path) as log:
+        return {name: log[name] for name in log.files}
+
+
+class _RecordingMotor:
+    def __init__(self, backend: 'RecordingBackend', motor, side: str):
+        self._backend = backend
+        self._motor = motor
+        self._side = side
+
+    def set_power(self, power: float) -> None:
+        self._motor.set_power(power)
+        self._backend._set_side(self._side, power)
+
+
+class _RecordingUltrasonic:
+    def __init__(self, backend: 'RecordingBackend'):
+        self._backend = backend
+
+    def get_distance(self) -> float:
+        dist = self._backend.hw.us.get_distance()
+        self._backend.recorder.radar(self._backend.servo_angle, dist)
+        return dist
+
+
+class _RecordingServo:
+    def __init__(self, backend: 'RecordingBackend'):
+        self._backend = backend
+
+    def set_angle(self, angle: float) -> None:
+        self._backend.hw.servo.set_angle(angle)
+        self._backend.servo_angle = angle
+
+
+class RecordingBackend:
+    """picar_4wd compatible wrapper that records what passes through it"""
+
+    def __init__(self, hw, recorder: Recorder):
+        self.hw = hw
+        self.recorder = recorder
+        self.servo_angle = 0.0
+        self._left = 0.0
+        self._right = 0.0
+        self.left_front = _RecordingMotor(self, hw.left_front, 'left')
+        self.left_rear = _RecordingMotor(self, hw.left_rear, 'left')
+        self.right_front = _RecordingMotor(self, hw.right_front, 'right')
+        self.right_rear = _RecordingMotor(self, hw.right_rear, 'right')
+        self.us = _RecordingUltrasonic(self)
+        self.servo = _RecordingServo(self)
+
+    def _set_side(self, side: str, power: float) -> None:
+        if side == 'left':
+            left, right = power, self._right
+        else:
+            left, right = self._left, power
+        self._motor(left, right)
+
+    def _motor(self, left: float, right: float) -> None:
+        if (left, right) != (self._left, self._right):
+            self._left, self._right = left, right
+            self.recorder.motor(left, right)
+
+    def forward(self, power: float) -> None:
+        self.hw.forward(power)
+        self._motor(power, power)
+
+    def backward(self, power: float) -> None:
+        self.hw.backward(power)
+        self._motor(-power, -power)
+
+    def turn_left(self, power: float) -> None:
+        self.hw.turn_left(power)
+        self._motor(-power, power)
+
+    def turn_right(self, power: float) -> None:
+        self.hw.turn_right(power)
+        self._motor(power, -power)
+
+    def stop(self) -> None:
+        self.hw.stop()
+        self._motor(0, 0)
+
+    def get_distance_at(self, angle: float) -> float:
+        self.servo.set_angle(angle)
+        return self.us.get_distance()
@@ -0,0 +1,182 @@
+"""Replay a recorded run through the mapper, planner and navigate at full speed
+
+Radar samples are served back in the order they were recorded and the virtual
+clock jumps to each sample's timestamp, so dead reckoning sees the same timing
+as the original run. Motor commands are ignored. Once the code under replay
+asks for a reading at another servo angle than the recording has, the replay
+stops, as every later sample would be attributed to the wrong angle.
+"""
+import argparse
+from queue import Empty
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from simulator import SimClock
+from tracking import STOP_SIGN, Detection
+
+
+class ReplayFinished(Exception):
+    """Raised when a replay runs out of recorded radar samples"""
+
+
+class ReplayDiverged(Exception):
+    """Raised when a reading is requested at another angle than recorded"""
+
+
+class _NullMotor:
+    def set_power(self, power: float) -> None:
+        pass
+
+
+class _ReplayServo:
+    def __init__(self, backend: 'ReplayBackend'):
+        self._backend = backend
+
+    def set_angle(self, angle: float) -> None:
+        self._backend.servo_angle = angle
+
+
+class _ReplayUltrasonic:
+    def __init__(self, backend: 'ReplayBackend'):
+        self._backend = backend
+
+    def get_distance(self) -> float:
+        return self._backend.next_distance()
+
+
+class ReplayBackend:
+    """picar_4wd compatible backend serving recorded radar samples"""
+
+    def __init__(self, log: Dict[str, np.ndarray], clock: SimClock,
+                 angle_tolerance: float = 0.5):
+        """
+        Args:
+            log (Dict[str, np.ndarray]): streams loaded with recorder.load
+            clock (SimClock): virtual clock set to the recorded timestamps
+            angle_tolerance (float, optional): degrees a requested servo angle
+                may differ from the recorded one. Defaults to 0.5.
+        """
+        self.clock = clock
+        self.angle_tolerance = angle_tolerance
+        self.servo_angle = 0.0
+        self._radar = log['radar']
+        self._index = 0
+        starts = [stream['t'][0] for stream in log.values() if len(stream)]
+        self.t0 = min(starts) if starts else 0.0
+
+        self.left_front = self.left_rear = _NullMotor()
+        self.right_front = self.right_rear = _NullMotor()
+        self.us = _ReplayUltrasonic(self)
+        self.servo = _ReplayServo(self)
+
+    def next_distance(self) -> float:
+        if self._index >= len(self._radar):
+            raise ReplayFinished()
+        sample = self._radar[self._index]
+        if abs(self.servo_angle - sample['angle']) > self.angle_tolerance:
+            raise ReplayDiverged(
+                f'radar sample {self._index} was recorded at '
+                f'{sample["angle"]:g} degrees but requested at '
+                f'{self.servo_angle:g}')
+        self._index += 1
+        self.clock.sleep(sample['t'] - self.t0 - self.clock.monotonic())
+        return float(sample['dist'])
+
+    @property
+    def samples_served(self) -> int:
+        return self._index
+
+    def forward(self, power: float) -> None:
+        pass
+
+    def backward(self, power: float) -> None:
+        pass
+
+    def turn_left(self, power: float) -> None:
+        pass
+
+    def turn_right(self, power: float) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def get_distance_at(self, angle: float) -> float:
+        self.servo.set_angle(angle)
+        return self.us.get_distance()
+
+
+class ReplayDetections:
+    """Queue-like source releasing recorded detections as the clock passes"""
+
+    def __init__(self, detections: np.ndarray, clock: SimClock, t0: float):
+        self._detections = detections
+        self._index = 0
+        self.clock = clock
+        self.t0 = t0
+
+    def get_nowait(self) -> List[Detection]:
+        if self._index >= len(self._detections):
+            raise Empty()
+        detection = self._detections[self._index]
+        if detection['t'] - self.t0 > self.clock.monotonic():
+            raise Empty()
+        self._index += 1
+        if not detection['stop_sign']:
+            return []
+        # only the decision was recorded, not the boxes
+        return [Detection(STOP_SIGN, 1.0, (0, 0, 0, 0), float(detection['t']),
+                          confirmed=True)]
+
+
+def replay(log: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """Run autopilot.main on a recorded log as fast as possible
+
+    Returns:
+        Dict[str, float]: replay statistics, diverged is set once the run
+            asked for a reading the recording does not have
+    """
+    import autopilot
+
+    clock = SimClock()
+    backend = ReplayBackend(log, clock)
+    detections = ReplayDetections(log['detection'], clock, backend.t0)
+
+    start_time = time.perf_counter()
+    reached = False
+    diverged = False
+    try:
+        reached = autopilot.main(hw=backend, clock=clock, plot=False,
+                                 queue=detections)
+    except ReplayFinished:
+        pass
+    except ReplayDiverged as e:
+        print('Replay diverged from the recording:', e)
+        diverged = True
+    elapsed = time.perf_counter() - start_time
+    return {
+        'reached': reached,
+        'diverged': diverged,
+        'samples': backend.samples_served,
+        'recorded_seconds': clock.monotonic(),
+        'replay_seconds': elapsed,
+        'speedup': clock.monotonic() / elapsed if elapsed else float('inf'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('log', help='Log saved with autopilot --record.')
+    args = parser.parse_args()
+
+    from recorder import load
+    stats = replay(load(args.log))
+    for name, value in stats.items():
+        print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Decide when the stop sign detector needs to run
+
+The car's motion and the mission state are written by the main process into
+shared memory and read by whichever process runs the detector, so the
+scheduler can be handed to a worker process as is.
+"""
+import math
+import multiprocessing as mp
+from typing import Optional
+
+import numpy as np
+
+
+class InferenceScheduler:
+    """Gate inference on car speed, scene change and mission state
+
+    The interval between inferences shrinks from max_interval when parked to
+    min_interval at cruise speed. Spinning in place, or turning tighter than
+    steering ever does, uses max_interval as the view is smeared and changes
+    too fast to matter. A frame that differs
+    enough from the last inferred one runs at min_interval regardless, and
+    nothing runs while paused.
+    """
+
+    _SPEED = 0
+    _TURN_RATE = 1
+    _PAUSED = 2
+
+    def __init__(self, min_interval: float = 0.2, max_interval: float = 2.0,
+                 cruise_speed: float = 1.25, max_curvature: float = 1.5,
+                 change_threshold: float = 12.0, thumb_step: int = 16):
+        """
+        Args:
+            min_interval (float, optional): seconds between inferences at
+                cruise speed or after a scene change. Defaults to 0.2.
+            max_interval (float, optional): seconds between inferences when
+                parked or spinning. Defaults to 2.0.
+            cruise_speed (float, optional): speed in cells per second that
+                gets min_interval. Defaults to 1.25.
+            max_curvature (float, optional): turn rate per speed, the inverse
+                of the turn radius in cells, above which the car counts as
+                spinning. Above autopilot.MAX_CURVATURE so that steering
+                along a path never does. Defaults to 1.5.
+            change_threshold (float, optional): mean absolute difference of
+                the frame thumbnails, 0 to 255, that counts as a scene change.
+                Defaults to 12.0.
+            thumb_step (int, optional): pixel stride of the thumbnails.
+                Defaults to 16.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cruise_speed = cruise_speed
+        self.max_curvature = max_curvature
+        self.change_threshold = change_threshold
+        self.thumb_step = thumb_step
+        self._state = mp.Array('d', [0.0, 0.0, 0.0])
+
+        self._last_run = -math.inf
+        self._last_thumb: Optional[np.ndarray] = None
+
+    def update_motion(self, speed: float, turn_rate: float) -> None:
+        """Record the car's current speed and turn rate"""
+        self._state[self._SPEED] = speed
+        self._state[self._TURN_RATE] = turn_rate
+
+    def pause(self) -> None:
+        """Stop inference entirely, e.g. once the stop sign was handled"""
+        self._state[self._PAUSED] = 1.0
+
+    def resume(self) -> None:
+        self._state[self._PAUSED] = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return self._state[self._PAUSED] != 0
+
+    def interval(self) -> float:
+        """Seconds between inferences for the current motion"""
+        speed = abs(self._state[self._SPEED])
+        # a turn rate threshold alone cannot tell them apart, steering at
+        # cruise speed turns faster than spinning in place
+        if abs(self._state[self._TURN_RATE]) > self.max_curvature * speed:
+            return self.max_interval
+        ratio = min(speed / self.cruise_speed, 1.0)
+        return self.max_interval + ratio * (self.min_interval -
+                                            self.max_interval)
+
+    def should_run(self, frame: np.ndarray, now: float) -> bool:
+        """Whether to run the detector on a frame
+
+        Args:
+            frame (np.ndarray): the raw camera frame
+            now (float): the current time in seconds
+
+        Returns:
+            bool: True if the detector should run. The frame then becomes the
+                reference for change detection.
+        """
+        if self.paused:
+            return False
+        # a strided single channel view is plenty to notice a scene change
+        thumb = frame[::self.thumb_step, ::self.thumb_step, 1].astype(np.int16)
+        interval = self.interval()
+        if self._last_thumb is not None and \
+                self._last_thumb.shape == thumb.shape and \
+                np.abs(thumb - self._last_thumb).mean() > self.change_threshold:
+            interval = self.min_interval
+        if now - self._last_run < interval:
+            return False
+        self._last_run = now
+        self._last_thumb = thumb
+        return True
@@ -0,0 +1,296 @@
+"""Deterministic picar_4wd backend that ray casts against a ground truth map
+
+The simulator runs on a virtual clock: every `sleep` advances simulated time
+instantly and integrates the wheel powers over it, so whole missions run far
+faster than real time. Pass a `Simulator` as `hw` and its `clock` as `clock`
+to `Car`, `Radar` or `autopilot.main`.
+
+`python simulator.py --check` runs a whole mission on the recorded map and
+fails unless the car reaches the destination. `--arena` drives in a walled
+room with a block to detour around instead, `--drift` miscalibrates dead
+reckoning and `--stopSign` reports a stop sign to stop at. `make check` runs
+the missions that matter.
+"""
+import argparse
+import math
+import sys
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+
+try:
+    import picar_4wd  # noqa: F401
+except ImportError:
+    # off the car common.py still needs something to import, the simulator
+    # itself is always passed in explicitly
+    import picar_4wd_mock
+    sys.modules['picar_4wd'] = picar_4wd_mock
+
+from common import Car
+from map import Mapper
+
+
+class SimClock:
+    """Virtual clock whose sleep advances time instantly"""
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+        self._listeners: List[Callable[[float], None]] = []
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def time(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        for listener in self._listeners:
+            listener(seconds)
+        self._now += seconds
+
+    def add_listener(self, listener: Callable[[float], None]) -> None:
+        """Call listener with the elapsed seconds whenever time advances"""
+        self._listeners.append(listener)
+
+
+class _Motor:
+    def __init__(self, powers: List[float], index: int):
+        self._powers = powers
+        self._index = index
+
+    def set_power(self, power: float) -> None:
+        self._powers[self._index] = power
+
+
+class _Ultrasonic:
+    def __init__(self, sim: 'Simulator'):
+        self._sim = sim
+
+    def get_distance(self) -> float:
+        return self._sim.ray_cast()
+
+
+class _Servo:
+    def __init__(self, sim: 'Simulator'):
+        self._sim = sim
+
+    def set_angle(self, angle: float) -> None:
+        self._sim.servo_angle = angle
+
+
+class Simulator:
+    """Simulated car driving on a ground truth occupancy grid
+
+    Only FILLED cells of the grid block the ultrasonic sensor. Distances are
+    returned in centimeters like the real sensor, and -2 when nothing is in
+    range. Wheel power maps to motion with the calibration in `Car`, so dead
+    reckoning is exact unless drift miscalibrates it.
+    """
+
+    def __init__(self, grid: np.ndarray, position: Iterable[float],
+                 dir_in_rad: float, clock: Optional[SimClock] = None,
+                 cm_per_cell: float = 7, max_range: float = 150,
+                 noise: float = 0.0, seed: Optional[int] = None,
+                 drift: float = 0.0):
+        """
+        Args:
+            grid (np.ndarray): ground truth map indexed as grid[y, x]
+            position (Iterable[float]): start position in the form of [x, y]
+            dir_in_rad (float): start direction in radians
+            clock (Optional[SimClock], optional): virtual clock to run on.
+                Defaults to a new clock.
+            cm_per_cell (float, optional): size of a grid cell. Defaults to 7.
+            max_range (float, optional): sensor range in centimeters.
+                Defaults to 150.
+            noise (float, optional): standard deviation of distance noise in
+                centimeters. Defaults to 0.
+            seed (Optional[int], optional): seed for the noise. Defaults to None.
+            drift (float, optional): fraction the car moves and turns further
+                than the calibration in `Car` assumes, so dead reckoning
+                drifts like on a real floor. Defaults to 0.
+        """
+        self.grid = grid
+        self.position = np.array(position, dtype=float)
+        self.dir = dir_in_rad
+        self.clock = clock if clock is not None else SimClock()
+        self.clock.add_listener(self._integrate)
+        self.cm_per_cell = cm_per_cell
+        self.max_range = max_range
+        self.noise = noise
+        self.drift = drift
+        self._rng = np.random.RandomState(seed)
+
+        self.servo_angle = 0.0
+        # left front, left rear, right front, right rear
+        self._powers = [0.0, 0.0, 0.0, 0.0]
+        self.left_front = _Motor(self._powers, 0)
+        self.left_rear = _Motor(self._powers, 1)
+        self.right_front = _Motor(self._powers, 2)
+        self.right_rear = _Motor(self._powers, 3)
+        self.us = _Ultrasonic(self)
+        self.servo = _Servo(self)
+
+    @classmethod
+    def from_file(cls, path: str, position: Iterable[float],
+                  dir_in_rad: float, **kwargs) -> 'Simulator':
+        """Load the ground truth grid from a saved .npy map"""
+        with open(path, "rb") as f:
+            grid = np.load(f)
+        return cls(grid, position, dir_in_rad, **kwargs)
+
+    def _set_powers(self, left: float, right: float) -> None:
+        self._powers[:] = [left, left, right, right]
+
+    def forward(self, power: float) -> None:
+        self._set_powers(power, power)
+
+    def backward(self, power: float) -> None:
+        self._set_powers(-power, -power)
+
+    def turn_left(self, power: float) -> None:
+        self._set_powers(-power, power)
+
+    def turn_right(self, power: float) -> None:
+        self._set_powers(power, -power)
+
+    def stop(self) -> None:
+        self._set_powers(0, 0)
+
+    def get_distance_at(self, angle: float) -> float:
+        self.servo.set_angle(angle)
+        return self.us.get_distance()
+
+    def velocity(self):
+        """Linear (cells/s) and angular (rad/s) velocity from wheel powers"""
+        left = (self._powers[0] + self._powers[1]) / 2
+        right = (self._powers[2] + self._powers[3]) / 2
+        speed, turn_rate = Car.velocity_from_power(left, right)
+        return speed * (1 + self.drift), turn_rate * (1 + self.drift)
+
+    def _integrate(self, duration: float) -> None:
+        speed, turn_rate = self.velocity()
+        if abs(turn_rate) < 1e-9:
+            self.position += speed * duration * np.array(
+                [math.cos(self.dir), math.sin(self.dir)])
+        else:
+            new_dir = self.dir + turn_rate * duration
+            radius = speed / turn_rate
+            self.position += radius * np.array(
+                [math.sin(new_dir) - math.sin(self.dir),
+                 math.cos(self.dir) - math.cos(new_dir)])
+            self.dir = new_dir
+        self.dir %= 2 * math.pi
+
+    def ray_cast(self) -> float:
+        """Distance in centimeters to the first filled cell along the sensor"""
+        angle = self.dir + math.radians(-self.servo_angle)
+        steps = np.arange(0, self.max_range / self.cm_per_cell, 0.25)
+        xs = np.round(self.position[0] + np.cos(angle) * steps).astype(int)
+        ys = np.round(self.position[1] + np.sin(angle) * steps).astype(int)
+        inside = (xs >= 0) & (xs < self.grid.shape[1]) & \
+            (ys >= 0) & (ys < self.grid.shape[0])
+        steps, xs, ys = steps[inside], xs[inside], ys[inside]
+        hits = np.flatnonzero(self.grid[ys, xs] == Mapper.FILLED)
+        if len(hits) == 0:
+            return -2
+        distance = steps[hits[0]] * self.cm_per_cell
+        if self.noise:
+            distance += self._rng.normal(0, self.noise)
+        return max(distance, 0)
+
+
+def arena(size: int) -> np.ndarray:
+    """Walled room with a block between the mission's start and the middle
+
+    The block sits across the straight line north from the start, so a
+    destination beyond it can only be reached by driving around it.
+    """
+    grid = np.full((size, size), Mapper.EMPTY, dtype=float)
+    middle = size // 2
+    # the side walls are in range of the sensor from the middle
+    left, right, bottom, top = middle - 12, middle + 12, 10, size - 12
+    grid[[bottom, top], left:right + 1] = Mapper.FILLED
+    grid[bottom:top + 1, [left, right]] = Mapper.FILLED
+    grid[27:30, middle - 4:middle + 5] = Mapper.FILLED
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--map',
+        help='Ground truth map to drive on.',
+        default='map-1676358884.1629941.npy')
+    parser.add_argument(
+        '--arena',
+        help='Drive in a walled room with a block in the way instead of on '
+             'the map.',
+        action='store_true')
+    parser.add_argument(
+        '--dest',
+        help='Cell to drive to.',
+        nargs=2, type=int, default=None)
+    parser.add_argument(
+        '--offset',
+        help='Cells of the ground truth map left and below the mission map.',
+        nargs=2, type=int, default=[45, 20])
+    parser.add_argument(
+        '--noise',
+        help='Standard deviation of distance noise in centimeters.',
+        type=float, default=0.0)
+    parser.add_argument(
+        '--seed',
+        help='Seed for the noise.',
+        type=int, default=None)
+    parser.add_argument(
+        '--drift',
+        help='Fraction the car moves and turns further than dead reckoning '
+             'assumes.',
+        type=float, default=0.0)
+    parser.add_argument(
+        '--stopSign',
+        help='Report a stop sign on the first control step.',
+        action='store_true')
+    parser.add_argument(
+        '--check',
+        help='Exit with status 1 unless the destination is reached and a '
+             'reported stop sign was stopped at.',
+        action='store_true')
+    args = parser.parse_args()
+
+    import autopilot
+
+    clock = SimClock()
+    if args.arena:
+        grid = arena(autopilot.MAP_SIZE)
+    else:
+        with open(args.map, "rb") as f:
+            grid = np.load(f)
+        x0, y0 = args.offset
+        grid = grid[y0:y0 + autopilot.MAP_SIZE, x0:x0 + autopilot.MAP_SIZE]
+    sim = Simulator(grid, (autopilot.MAP_SIZE // 2, 20), math.radians(90),
+                    clock=clock, noise=args.noise, seed=args.seed,
+                    drift=args.drift)
+    queue = None
+    if args.stopSign:
+        from queue import Queue
+        from tracking import STOP_SIGN, Detection
+
+        queue = Queue()
+        queue.put([Detection(STOP_SIGN, 1.0, (0, 0, 1, 1), clock.monotonic(),
+                             confirmed=True)])
+    dest = tuple(args.dest) if args.dest else autopilot.DESTINATION
+    reached = autopilot.main(hw=sim, clock=clock, plot=False, queue=queue,
+                             dest=dest)
+    stopped = autopilot.ignore_stop_sign
+    print("Reached:", reached, "simulated seconds:", clock.monotonic(),
+          "final position:", sim.position, "stopped at stop sign:", stopped)
+    if args.check and (not reached or args.stopSign and not stopped):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Keep heavy imports off the startup path and profile what startup costs
+
+The core mapping and planning modules only import numpy at load time. SciPy,
+matplotlib, OpenCV and TFLite are imported where they are used, and a
+Prewarmer imports them on a background thread while the car already scans, so
+neither startup nor the first call waits for them.
+
+Run this module to print where the import time of a module goes, e.g.
+`python startup.py autopilot --save startup.json`, and later
+`python startup.py autopilot --baseline startup.json` to fail on regressions.
+"""
+import argparse
+import importlib
+import json
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+# needed by planning and localization
+CORE_MODULES = ('scipy.ndimage',)
+# needed by plotting
+PLOT_MODULES = ('matplotlib.pyplot',)
+
+
+class Prewarmer:
+    """Import modules on a daemon thread
+
+    Importing a module that is being prewarmed simply waits for it, so
+    callers do not need to coordinate with the thread. Processes should be
+    started before prewarming, a fork in the middle of an import can leave
+    the child waiting on the import lock forever.
+    """
+
+    def __init__(self, modules: Iterable[str]):
+        self.modules = tuple(modules)
+        # seconds each module took to import, failed ones are left out
+        self.timings: Dict[str, float] = {}
+        self.failed: Dict[str, str] = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        for name in self.modules:
+            start = time.perf_counter()
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                self.failed[name] = repr(e)
+                continue
+            self.timings[name] = time.perf_counter() - start
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for all imports, returns False on timeout"""
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
+class ImportTime(NamedTuple):
+    module: str
+    # seconds spent in the module itself and including its imports
+    self_time: float
+    cumulative: float
+
+
+def import_breakdown(module: str) -> List[ImportTime]:
+    """Import time of every module pulled in by importing a module
+
+    The module is imported in a fresh interpreter with `-X importtime`, so
+    nothing the caller already imported hides its cost.
+
+    Args:
+        module (str): name of the module to import
+
+    Returns:
+        List[ImportTime]: all imported modules, slowest first
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        times.append(ImportTime(fields[2].strip(), int(fields[0]) / 1e6,
+                                int(fields[1]) / 1e6))
+    return sorted(times, key=lambda t: -t.cumulative)
+
+
+def regressions(current: Dict[str, float], baseline: Dict[str, float],
+                tolerance: float = 0.25,
+                min_seconds: float = 0.05) -> Dict[str, float]:
+    """Modules whose cumulative import time grew beyond the tolerance
+
+    Modules that are new since the baseline count from zero, and changes
+    below min_seconds are ignored as noise.
+
+    Returns:
+        Dict[str, float]: seconds each regressed module got slower
+    """
+    slower = {}
+    for module, seconds in current.items():
+        before = baseline.get(module, 0.0)
+        if seconds - before > max(before * tolerance, min_seconds):
+            slower[module] = seconds - before
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('module', nargs='?', default='autopilot',
+                        help='Module whose import time to profile.')
+    parser.add_argument('-n', '--top', type=int, default=15,
+                        help='Number of slowest modules to print.')
+    parser.add_argument('--save', default=None,
+                        help='Save the breakdown to this .json file.')
+    parser.add_argument('--baseline', default=None,
+                        help='Compare against a breakdown saved earlier.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown per module.')
+    args = parser.parse_args()
+
+    times = import_breakdown(args.module)
+    print(f'{"module":<40}{"self ms":>10}{"total ms":>10}')
+    for t in times[:args.top]:
+        print(f'{t.module:<40}{t.self_time * 1000:>10.1f}'
+              f'{t.cumulative * 1000:>10.1f}')
+
+    cumulative = {t.module: t.cumulative for t in times}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(cumulative, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(cumulative, json.load(f), args.tolerance)
+        for module, seconds in sorted(slower.items(), key=lambda s: -s[1]):
+            print(f'regression: {module} +{seconds * 1000:.1f} ms')
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
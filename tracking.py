@@ -0,0 +1,221 @@
+"""Structured detections and a cheap tracker between model keyframes
+
+OpenCV is only imported by the tracker itself, so the control side can use
+Detection without it.
+"""
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+STOP_SIGN = "stop sign"
+
+
+class Detection(NamedTuple):
+    label: str
+    score: float
+    # x, y, width and height in pixels of the flipped camera frame
+    box: Tuple[int, int, int, int]
+    # capture time of the frame on the time.monotonic clock
+    timestamp: float
+    track_id: int = -1
+    # whether the model saw it in this frame rather than the tracker
+    keyframe: bool = True
+    # whether the model saw it on enough consecutive keyframes to act on
+    confirmed: bool = False
+
+
+def has_stop_sign(detections: Sequence[Detection]) -> bool:
+    """Whether any confirmed detection is a stop sign"""
+    return any(d.label == STOP_SIGN and d.confirmed for d in detections)
+
+
+def _iou(a: np.ndarray, b: np.ndarray) -> float:
+    """Intersection over union of two (x, y, width, height) boxes"""
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0.0, x1 - x0) * max(0.0, y1 - y0)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+class _Track:
+    def __init__(self, track_id: int, detection: Detection, box: np.ndarray,
+                 template: np.ndarray):
+        self.track_id = track_id
+        self.label = detection.label
+        self.score = detection.score
+        # x, y, width, height on the downscaled raw frame
+        self.box = box
+        self.template = template
+        self.frames = 0
+        self.misses = 0
+        self.confirmed = False
+
+
+class DetectionTracker:
+    """Propagate model detections between keyframes with template matching
+
+    On a keyframe the model's detections are associated with the existing
+    tracks by overlap and each track keeps a grayscale template of its box. On
+    the frames in between every track is searched for near its last position
+    on a downscaled grayscale frame, which costs a fraction of a model run.
+    A track is confirmed once the model saw it on confirm_frames keyframes in
+    a row, template matching only keeps it alive in between, so a single
+    false positive of the model is never acted on. A track is dropped after
+    max_misses frames without it.
+
+    Tracking works on the raw camera frame, boxes are converted from and to
+    the flipped frame detections are reported in.
+    """
+
+    def __init__(self, scale: int = 4, min_match: float = 0.6,
+                 min_iou: float = 0.3, confirm_frames: int = 2,
+                 max_misses: int = 3):
+        """
+        Args:
+            scale (int, optional): downscaling of the frame used for tracking.
+                Defaults to 4.
+            min_match (float, optional): lowest normalized correlation that
+                counts as finding a track again. Defaults to 0.6.
+            min_iou (float, optional): lowest overlap for a detection to
+                continue a track. Defaults to 0.3.
+            confirm_frames (int, optional): consecutive keyframes with a
+                model detection needed to confirm a track. Defaults to 2.
+            max_misses (int, optional): frames a track may go unseen before
+                it is dropped. Defaults to 3.
+        """
+        self.scale = scale
+        self.min_match = min_match
+        self.min_iou = min_iou
+        self.confirm_frames = confirm_frames
+        self.max_misses = max_misses
+        self.tracks: Dict[int, _Track] = {}
+        self._next_id = 0
+        self._frame_size: Tuple[int, int] = (0, 0)
+
+    def _gray(self, frame: np.ndarray) -> np.ndarray:
+        import cv2
+
+        height, width = frame.shape[:2]
+        self._frame_size = (width, height)
+        small = cv2.resize(frame, (width // self.scale, height // self.scale),
+                           interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def _to_raw(self, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """Flipped frame box to downscaled raw frame box"""
+        width, height = self._frame_size
+        x, y, w, h = box
+        return np.array([width - x - w, height - y - h, w, h],
+                        dtype=float) / self.scale
+
+    def _to_flipped(self, box: np.ndarray) -> Tuple[int, int, int, int]:
+        """Downscaled raw frame box to flipped frame box"""
+        width, height = self._frame_size
+        x, y, w, h = box * self.scale
+        return (int(round(width - x - w)), int(round(height - y - h)),
+                int(round(w)), int(round(h)))
+
+    @staticmethod
+    def _crop(gray: np.ndarray, box: np.ndarray) -> Optional[np.ndarray]:
+        x, y, w, h = np.round(box).astype(int)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, gray.shape[1]), min(y + h, gray.shape[0])
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        return gray[y0:y1, x0:x1].copy()
+
+    def _miss(self, track: _Track) -> None:
+        track.misses += 1
+        track.frames = 0
+        if track.misses > self.max_misses:
+            del self.tracks[track.track_id]
+
+    def _hit(self, track: _Track, keyframe: bool) -> None:
+        track.misses = 0
+        if not keyframe:
+            return
+        track.frames += 1
+        if track.frames >= self.confirm_frames:
+            track.confirmed = True
+
+    def _report(self, timestamp: float, keyframe: bool) -> List[Detection]:
+        return [Detection(t.label, t.score, self._to_flipped(t.box), timestamp,
+                          t.track_id, keyframe, t.confirmed)
+                for t in self.tracks.values() if t.misses == 0]
+
+    def update(self, frame: np.ndarray, detections: Sequence[Detection],
+               timestamp: float) -> List[Detection]:
+        """Take the model's detections on a keyframe
+
+        Args:
+            frame (np.ndarray): the raw camera frame the model ran on
+            detections (Sequence[Detection]): the model's detections
+            timestamp (float): capture time of the frame
+
+        Returns:
+            List[Detection]: the tracked detections in the frame
+        """
+        gray = self._gray(frame)
+        unmatched = dict(self.tracks)
+        for detection in sorted(detections, key=lambda d: -d.score):
+            box = self._to_raw(detection.box)
+            template = self._crop(gray, box)
+            if template is None:
+                continue
+            best, best_iou = None, self.min_iou
+            for track in unmatched.values():
+                overlap = _iou(track.box, box)
+                if track.label == detection.label and overlap >= best_iou:
+                    best, best_iou = track, overlap
+            if best is None:
+                track = _Track(self._next_id, detection, box, template)
+                self._next_id += 1
+                self.tracks[track.track_id] = track
+                self._hit(track, keyframe=True)
+                continue
+            del unmatched[best.track_id]
+            best.box, best.template = box, template
+            best.score = detection.score
+            self._hit(best, keyframe=True)
+        for track in unmatched.values():
+            self._miss(track)
+        return self._report(timestamp, keyframe=True)
+
+    def track(self, frame: np.ndarray, timestamp: float) -> List[Detection]:
+        """Propagate the tracks onto a frame the model did not run on
+
+        Args:
+            frame (np.ndarray): the raw camera frame
+            timestamp (float): capture time of the frame
+
+        Returns:
+            List[Detection]: the tracked detections in the frame
+        """
+        if not self.tracks:
+            return []
+        import cv2
+
+        gray = self._gray(frame)
+        for track in list(self.tracks.values()):
+            th, tw = track.template.shape
+            # search half a box around the last position
+            margin = np.array([tw, th]) / 2
+            x0, y0 = np.maximum(track.box[:2] - margin, 0).astype(int)
+            x1, y1 = np.minimum(track.box[:2] + track.box[2:] + margin,
+                                gray.shape[::-1]).astype(int)
+            region = gray[y0:y1, x0:x1]
+            if region.shape[0] < th or region.shape[1] < tw:
+                self._miss(track)
+                continue
+            scores = cv2.matchTemplate(region, track.template,
+                                       cv2.TM_CCOEFF_NORMED)
+            _, best, _, (bx, by) = cv2.minMaxLoc(scores)
+            if best < self.min_match:
+                self._miss(track)
+                continue
+            track.box = np.array([x0 + bx, y0 + by, tw, th], dtype=float)
+            self._hit(track, keyframe=False)
+        return self._report(timestamp, keyframe=False)
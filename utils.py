@@ -13,45 +13,48 @@
 # limitations under the License.
 """Utility functions to display the pose detection results."""
 
+from typing import Sequence
+
 import cv2
 import numpy as np
-from tflite_support.task import processor
+
+from tracking import Detection
 
 _MARGIN = 10  # pixels
 _ROW_SIZE = 10  # pixels
 _FONT_SIZE = 1
 _FONT_THICKNESS = 1
 _TEXT_COLOR = (0, 0, 255)  # red
+_TRACKED_COLOR = (0, 255, 255)  # yellow
 
 
 def visualize(
     image: np.ndarray,
-    detection_result: processor.DetectionResult,
+    detections: Sequence[Detection],
 ) -> np.ndarray:
     """Draws bounding boxes on the input image and return it.
 
+    Confirmed detections are drawn in red, ones that are still being confirmed
+    in yellow.
+
     Args:
-      image: The input RGB image.
-      detection_result: The list of all "Detection" entities to be visualize.
+      image: The flipped BGR camera frame the detections refer to.
+      detections: The detections to visualize.
 
     Returns:
       Image with bounding boxes.
     """
-    for detection in detection_result.detections:
+    for detection in detections:
+        color = _TEXT_COLOR if detection.confirmed else _TRACKED_COLOR
         # Draw bounding_box
-        bbox = detection.bounding_box
-        start_point = bbox.origin_x, bbox.origin_y
-        end_point = bbox.origin_x + bbox.width, bbox.origin_y + bbox.height
-        cv2.rectangle(image, start_point, end_point, _TEXT_COLOR, 3)
+        x, y, width, height = detection.box
+        cv2.rectangle(image, (x, y), (x + width, y + height), color, 3)
 
         # Draw label and score
-        category = detection.categories[0]
-        category_name = category.category_name
-        probability = round(category.score, 2)
-        result_text = category_name + ' (' + str(probability) + ')'
-        text_location = (_MARGIN + bbox.origin_x,
-                         _MARGIN + _ROW_SIZE + bbox.origin_y)
+        probability = round(detection.score, 2)
+        result_text = detection.label + ' (' + str(probability) + ')'
+        text_location = (_MARGIN + x, _MARGIN + _ROW_SIZE + y)
         cv2.putText(image, result_text, text_location, cv2.FONT_HERSHEY_PLAIN,
-                    _FONT_SIZE, _TEXT_COLOR, _FONT_THICKNESS)
+                    _FONT_SIZE, color, _FONT_THICKNESS)
 
     return image
@@ -0,0 +1,314 @@
+"""Run stop sign detection in a worker process fed through shared memory
+
+The camera is read on a thread of the main process and every frame is copied
+into a small ring of slots in shared memory. The worker process preprocesses
+and runs the model on a copy of the newest slot and sends compact results back
+over a pipe, so TFLite and OpenCV never hold the main process's GIL.
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from queue import Empty
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from scheduler import InferenceScheduler
+from tracking import Detection
+
+
+class FrameRing:
+    """Fixed number of frame slots in shared memory, the newest frame wins
+
+    Each slot stores the id of the frame in it. The id is cleared while the
+    slot is written, so a reader can tell if a frame was overwritten while it
+    was being read.
+    """
+
+    def __init__(self, shape: Tuple[int, int, int], slots: int = 3,
+                 name: Optional[str] = None):
+        """
+        Args:
+            shape (Tuple[int, int, int]): frame shape as (height, width, 3)
+            slots (int, optional): number of frames kept. Defaults to 3.
+            name (Optional[str], optional): attach to an existing ring instead
+                of creating one. Defaults to None.
+        """
+        self.shape = shape
+        self.slots = slots
+        frames_size = slots * int(np.prod(shape))
+        size = frames_size + slots * 16 + 8
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8,
+                                 buffer=self.shm.buf)
+        self.ids = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf,
+                              offset=frames_size)
+        self.stamps = np.ndarray((slots,), dtype=np.float64,
+                                 buffer=self.shm.buf,
+                                 offset=frames_size + slots * 8)
+        self.latest = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf,
+                                 offset=frames_size + slots * 16)
+        self._owner = name is None
+        self._next_id = 1
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        """Copy a frame into the next slot"""
+        frame_id = self._next_id
+        self._next_id += 1
+        slot = frame_id % self.slots
+        self.ids[slot] = 0
+        if frame.shape == self.frames.shape[1:]:
+            np.copyto(self.frames[slot], frame)
+        else:
+            import cv2
+            cv2.resize(frame, (self.shape[1], self.shape[0]),
+                       dst=self.frames[slot])
+        self.stamps[slot] = timestamp
+        self.ids[slot] = frame_id
+        self.latest[0] = frame_id
+
+    def read(self, last_id: int) -> Optional[Tuple[int, np.ndarray, float]]:
+        """Return the newest frame if it is newer than last_id
+
+        Returns:
+            Optional[Tuple[int, np.ndarray, float]]: frame id, a view of the
+                frame in shared memory and its capture timestamp
+        """
+        frame_id = int(self.latest[0])
+        if frame_id == last_id:
+            return None
+        slot = frame_id % self.slots
+        timestamp = float(self.stamps[slot])
+        if not self.valid(frame_id):
+            return None
+        return frame_id, self.frames[slot], timestamp
+
+    def valid(self, frame_id: int) -> bool:
+        """Whether the frame is still in its slot"""
+        return int(self.ids[frame_id % self.slots]) == frame_id
+
+    def close(self) -> None:
+        del self.frames, self.ids, self.stamps, self.latest
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+def _detect_worker(ring_name: str, shape: Tuple[int, int, int], slots: int,
+                   model: str, num_threads: int, enable_edgetpu: bool,
+                   input_size: Optional[Tuple[int, int]],
+                   roi: Optional[Tuple[float, float, float, float]],
+                   scheduler: InferenceScheduler, new_frame, stop,
+                   conn) -> None:
+    """Detect objects in the newest frames of the ring until stopped
+
+    The first message sent is None once the model is loaded. A failure is
+    sent as a string before the worker exits.
+    """
+    ring = FrameRing(shape, slots, name=ring_name)
+    try:
+        import detect
+        from preprocess import FramePreprocessor
+        from tracking import DetectionTracker
+
+        preprocess = FramePreprocessor(input_size, roi)
+        tracker = DetectionTracker()
+        detector = detect.create_detector(model, num_threads, enable_edgetpu)
+    except Exception as e:
+        ring.close()
+        _send_error(conn, e)
+        return
+    conn.send(None)
+    # the capture thread keeps overwriting the ring, so every frame is copied
+    # out before anything looks at it
+    frame = np.empty(shape, dtype=np.uint8)
+    last_id = 0
+    try:
+        while not stop.is_set():
+            if scheduler.paused:
+                stop.wait(0.1)
+                continue
+            if not new_frame.wait(0.1):
+                continue
+            new_frame.clear()
+            latest = ring.read(last_id)
+            if latest is None:
+                continue
+            frame_id, slot, timestamp = latest
+            np.copyto(frame, slot)
+            del slot
+            if not ring.valid(frame_id):
+                # overwritten while copying, try the newer one
+                continue
+            last_id = frame_id
+            if not scheduler.should_run(frame, time.monotonic()):
+                # between keyframes only the tracker follows what was seen
+                detections = tracker.track(frame, timestamp)
+                if detections:
+                    conn.send(detections)
+                continue
+            rgb_image = preprocess(frame)
+            objects = detect.detect_objects(detector, rgb_image, preprocess,
+                                            timestamp)
+            conn.send(tracker.update(frame, objects, timestamp))
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    except Exception as e:
+        _send_error(conn, e)
+    finally:
+        ring.close()
+
+
+def _send_error(conn, error: Exception) -> None:
+    try:
+        conn.send(f'{type(error).__name__}: {error}')
+    except OSError:
+        pass
+
+
+class DetectionWorker:
+    """Capture frames and detect stop signs in a separate process
+
+    Behaves like the queue navigate reads from: get_nowait returns the
+    detections of the next frame that was processed, or raises Empty. It
+    raises RuntimeError once the worker failed or the camera stopped, so the
+    car never keeps driving without stop sign detection.
+    """
+
+    def __init__(self, model: str, camera_id: int = 0, width: int = 640,
+                 height: int = 480, num_threads: int = 4,
+                 enable_edgetpu: bool = False,
+                 input_size: Optional[Tuple[int, int]] = (320, 320),
+                 roi: Optional[Tuple[float, float, float, float]] = None,
+                 scheduler: Optional[InferenceScheduler] = None,
+                 slots: int = 3, debug=None, start_timeout: float = 30.0):
+        """
+        Args:
+            model (str): name of the TFLite object detection model
+            camera_id (int, optional): camera id for OpenCV. Defaults to 0.
+            width (int, optional): frame width. Defaults to 640.
+            height (int, optional): frame height. Defaults to 480.
+            num_threads (int, optional): CPU threads of the model. Defaults
+                to 4.
+            enable_edgetpu (bool, optional): run on the EdgeTPU. Defaults to
+                False.
+            input_size (Optional[Tuple[int, int]], optional): model input size.
+                Defaults to (320, 320).
+            roi (Optional[Tuple[float, float, float, float]], optional):
+                region of interest, see preprocess.FramePreprocessor.
+                Defaults to None.
+            scheduler (Optional[InferenceScheduler], optional): decides which
+                frames to run the model on. Defaults to a new scheduler.
+            slots (int, optional): frames in the shared memory ring. Defaults
+                to 3.
+            debug (optional): debug_stream.DebugStream shown the frames and
+                detections. Defaults to None.
+            start_timeout (float, optional): seconds to wait for the worker
+                to load the model. Defaults to 30.0.
+
+        Raises:
+            RuntimeError: if the camera cannot be opened or the worker fails
+                to start
+        """
+        # latency from capture to result of the last detection, in seconds
+        self.latency = 0.0
+        self.debug = debug
+        self.scheduler = scheduler if scheduler is not None \
+            else InferenceScheduler()
+        self._new_frame = mp.Event()
+        self._stop = mp.Event()
+        self._conn, child_conn = mp.Pipe(duplex=False)
+        self._process: Optional[mp.Process] = None
+        self._capture = None
+        self.ring = FrameRing((height, width, 3), slots)
+        try:
+            self._process = mp.Process(
+                target=_detect_worker,
+                args=(self.ring.name, self.ring.shape, slots, model,
+                      num_threads, enable_edgetpu, input_size, roi,
+                      self.scheduler, self._new_frame, self._stop,
+                      child_conn),
+                daemon=True)
+            self._process.start()
+            child_conn.close()
+
+            # the camera opens while the worker loads the model
+            from detect import LatestFrameCapture
+            self._capture = LatestFrameCapture(camera_id, width, height,
+                                               on_frame=self._on_frame)
+            if not self._capture.running:
+                raise RuntimeError(f'Unable to open camera {camera_id}')
+            if not self._conn.poll(start_timeout):
+                raise RuntimeError('Detection worker did not start in '
+                                   f'{start_timeout} seconds')
+            self._receive()
+        except BaseException:
+            self.close()
+            raise
+
+    def _on_frame(self, frame: np.ndarray, timestamp: float) -> None:
+        self.ring.write(frame, timestamp)
+        self._new_frame.set()
+        if self.debug is not None:
+            self.debug.submit_frame(frame)
+
+    def update_motion(self, speed: float, turn_rate: float) -> None:
+        """Let the scheduler know how the car is moving"""
+        self.scheduler.update_motion(speed, turn_rate)
+
+    def pause(self) -> None:
+        """Stop running the model until resumed"""
+        self.scheduler.pause()
+
+    def _receive(self) -> Optional[List[Detection]]:
+        """Receive the next message of the worker, raising its failures"""
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            raise RuntimeError('Detection worker exited with code '
+                               f'{self._process.exitcode}') from None
+        if isinstance(message, str):
+            raise RuntimeError(f'Detection worker failed: {message}')
+        return message
+
+    def get_nowait(self) -> List[Detection]:
+        # checked first, a worker that exited has sent all it ever will
+        alive = self._process.is_alive()
+        if not self._conn.poll():
+            if not alive:
+                raise RuntimeError('Detection worker exited with code '
+                                   f'{self._process.exitcode}')
+            if not self._capture.running:
+                raise RuntimeError('Camera stopped delivering frames')
+            raise Empty()
+        detections = self._receive()
+        if detections:
+            self.latency = time.monotonic() - detections[0].timestamp
+        if self.debug is not None:
+            self.debug.set_detections(detections)
+        return detections
+
+    def close(self) -> None:
+        """Stop capturing, shut the worker down and free the ring"""
+        if self._capture is not None:
+            self._capture.release()
+        self._stop.set()
+        if self._process is not None:
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+        self.ring.close()
+
+    def __enter__(self) -> 'DetectionWorker':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()